@@ -0,0 +1,297 @@
+"""
+Vectorized NumPy versions of the mathnet samplers.
+
+sample_number_pairs follows the same rules as make_number_pairs (the top number has at
+least two digits, the bottom number never has more digits than the top one, and the pair
+is swapped so that top >= bottom) but draws whole arrays at once instead of looping in
+Python. Operands that fit in int64 are drawn directly; wider ones are drawn digit by digit
+as a digit matrix, which is exact for any width.
+
+batch_add_prompts and batch_subtract_prompts lay a batch of problems out as padded digit
+matrices, compute every column sum, carry and borrow with array operations and render the
+same traces as make_add_prompt and make_subtract_prompt.
+"""
+
+from functools import lru_cache
+from itertools import islice
+
+import numpy as np
+
+from mathnet_dset import OPERATIONS, TEMPLATES, place_names
+
+
+# 10**18 - 1 is the widest all-nines number that fits in an int64
+INT64_DIGITS = 18
+
+# Pairs drawn per call when streaming, shared so every streaming path draws the same pairs
+SAMPLE_BATCH = 65536
+
+
+def _digit_lengths(num, max_digits, rng):
+    digits_top = np.maximum(2, rng.integers(1, max_digits + 1, size=num))
+    digits_bottom = np.minimum(digits_top, rng.integers(1, max_digits + 1, size=num))
+    return digits_top, digits_bottom
+
+
+def _sample_int64(lengths, rng):
+    low = 10 ** (lengths - 1)
+    return rng.integers(low, 10 * low, dtype=np.int64)
+
+
+def _sample_digit_matrix(lengths, width, rng):
+    """
+    Draws one number per entry of lengths as a right aligned (num, width) uint8 digit
+    matrix, zero padded on the left. The leading digit is drawn from 1-9 and the rest
+    from 0-9, which is uniform over all numbers with that many digits.
+    """
+    num = len(lengths)
+    digits = rng.integers(0, 10, size=(num, width), dtype=np.uint8)
+    leading = rng.integers(1, 10, size=num, dtype=np.uint8)
+
+    columns = np.arange(width)
+    start = width - lengths
+    digits[columns[None, :] < start[:, None]] = 0
+    digits[np.arange(num), start] = leading
+    return digits
+
+
+def _digit_matrix_to_bytes(digits):
+    """
+    Converts a right aligned digit matrix into an array of zero padded ASCII byte strings
+    """
+    width = digits.shape[1]
+    return np.ascontiguousarray(digits + ord("0")).view(f"S{width}").ravel()
+
+
+def _bytes_to_str(padded):
+    return np.char.lstrip(padded, b"0").astype(str).tolist()
+
+
+def sample_number_pairs(num=100, max_digits=3, rng=None):
+    """
+    Generates num (top, bottom) pairs of digit strings with top >= bottom, like
+    make_number_pairs. rng may be a seed or a numpy Generator.
+    """
+    rng = np.random.default_rng(rng)
+    digits_top, digits_bottom = _digit_lengths(num, max_digits, rng)
+
+    if max_digits <= INT64_DIGITS:
+        top = _sample_int64(digits_top, rng)
+        bottom = _sample_int64(digits_bottom, rng)
+        top, bottom = np.maximum(top, bottom), np.minimum(top, bottom)
+        return list(zip(top.astype(str).tolist(), bottom.astype(str).tolist()))
+
+    top = _digit_matrix_to_bytes(_sample_digit_matrix(digits_top, max_digits, rng))
+    bottom = _digit_matrix_to_bytes(_sample_digit_matrix(digits_bottom, max_digits, rng))
+    # equal width zero padded digit strings compare the same way as the numbers they hold
+    swap = bottom > top
+    top, bottom = np.where(swap, bottom, top), np.where(swap, top, bottom)
+    return list(zip(_bytes_to_str(top), _bytes_to_str(bottom)))
+
+
+def iter_sampled_pairs(num=100, max_digits=3, rng=None, batch_size=SAMPLE_BATCH):
+    """
+    Yields num pairs from sample_number_pairs, drawing batch_size of them at a time so
+    memory stays bounded for very large num. Has the same signature as iter_number_pairs
+    so it can be passed as the sampler to iter_problem_examples.
+    """
+    rng = np.random.default_rng(rng)
+    for start in range(0, num, batch_size):
+        yield from sample_number_pairs(min(batch_size, num - start), max_digits, rng)
+
+
+def digit_matrix(numbers, width=None):
+    """
+    Lays out a list of digit strings as an (n, width) uint8 matrix, least significant
+    digit in column 0 and zero padded past each number's length. Also returns the lengths.
+    """
+    encoded = np.array(numbers, dtype="S")
+    lengths = np.char.str_len(encoded)
+    if width is None:
+        width = int(lengths.max()) if len(numbers) else 1
+    padded = np.char.rjust(encoded, width, b"0").astype(f"S{width}")
+    digits = padded.view(np.uint8).reshape(len(numbers), width) - ord("0")
+    return np.ascontiguousarray(digits[:, ::-1]), lengths
+
+
+def add_carries(top, bot):
+    """
+    Computes every column of many additions at once from two digit matrices.
+    Returns (carry_in, column_sum, carry_out) matrices. The carry chain is walked one
+    column at a time, but each step covers every problem in the batch.
+    """
+    carry_in = np.zeros_like(top)
+    column_sum = np.zeros_like(top)
+    carry = np.zeros(len(top), dtype=top.dtype)
+    for i in range(top.shape[1]):
+        carry_in[:, i] = carry
+        column_sum[:, i] = top[:, i] + bot[:, i] + carry
+        carry = column_sum[:, i] // 10
+    return carry_in, column_sum, column_sum // 10
+
+
+def subtract_borrows(top, bot):
+    """
+    Computes every column of many subtractions (top >= bot) at once from two digit matrices.
+    Returns (borrow_in, column_sub, borrow_out) matrices.
+    """
+    borrow_in = np.zeros_like(top)
+    borrow_out = np.zeros_like(top)
+    borrow = np.zeros(len(top), dtype=top.dtype)
+    for i in range(top.shape[1]):
+        borrow_in[:, i] = borrow
+        borrow = (top[:, i] < bot[:, i] + borrow).astype(top.dtype)
+        borrow_out[:, i] = borrow
+    column_sub = top.astype(np.int16) - bot - borrow_in + 10 * borrow_out
+    return borrow_in, column_sub.astype(top.dtype), borrow_out
+
+
+@lru_cache(maxsize=None)
+def _add_lines(width, verbosity="full"):
+    """
+    Every possible addition step line, indexed by [place, past_bottom, top, bot, carry_in]
+    """
+    text = TEMPLATES[verbosity]
+    places = place_names(width)
+    lines = np.empty((width, 2, 10, 10, 2), dtype=object)
+    for i, place in enumerate(places):
+        for top_digit in range(10):
+            for bot_digit in range(10):
+                for carry in range(2):
+                    column_sum = top_digit + bot_digit + carry
+                    fields = dict(
+                        place=place,
+                        top_digit=top_digit,
+                        bot_digit=bot_digit,
+                        carry=carry,
+                        column_sum=column_sum,
+                        remainder=column_sum % 10,
+                        new_carry=column_sum // 10,
+                    )
+                    lines[i, 0, top_digit, bot_digit, carry] = text["add_step"].format(**fields)
+                    lines[i, 1, top_digit, bot_digit, carry] = text["add_step_past"].format(**fields)
+    return lines
+
+
+@lru_cache(maxsize=None)
+def _subtract_lines(width, verbosity="full"):
+    """
+    Every possible subtraction step line, indexed by [place, top, bot, borrow_in]
+    """
+    text = TEMPLATES[verbosity]
+    places = place_names(width)
+    lines = np.empty((width, 10, 10, 2), dtype=object)
+    for i, place in enumerate(places):
+        for top_digit in range(10):
+            for bot_digit in range(10):
+                for borrow_in in range(2):
+                    column_sub = top_digit - bot_digit - borrow_in
+                    borrow = int(column_sub < 0)
+                    lines[i, top_digit, bot_digit, borrow_in] = text["sub_step"].format(
+                        place=place,
+                        top_digit=top_digit,
+                        borrowed_top=top_digit + 10 * borrow,
+                        bot_digit=bot_digit,
+                        borrow_in=borrow_in,
+                        borrow=borrow,
+                        column_sub=column_sub + 10 * borrow,
+                    )
+    return lines
+
+
+def _result_strings(digits, lengths):
+    """
+    Turns a least significant first digit matrix into strings holding each row's last lengths digits
+    """
+    width = digits.shape[1]
+    padded = np.ascontiguousarray(digits[:, ::-1] + ord("0")).view(f"S{width}").ravel()
+    return [row[width - length :].decode() for row, length in zip(padded.tolist(), lengths.tolist())]
+
+
+def batch_add_prompts(problems, verbosity="full"):
+    """
+    Builds make_add_prompt outputs for a whole list of (top, bottom) pairs at once.
+    Column sums and carries come from add_carries and every step line is looked up from
+    a table, so the only per example work left is joining the lines.
+    """
+    tops = [top for top, _ in problems]
+    bots = [bot for _, bot in problems]
+    top, top_len = digit_matrix(tops)
+    width = top.shape[1]
+    bot, bot_len = digit_matrix(bots, width)
+
+    carry_in, column_sum, carry_out = add_carries(top, bot)
+    columns = np.arange(width)
+    past_bottom = (columns[None, :] >= bot_len[:, None]).astype(np.intp)
+    lines = _add_lines(width, verbosity)[columns[None, :], past_bottom, top, bot, carry_in]
+
+    # the final carry becomes one extra leading digit
+    final_carry = carry_out[np.arange(len(problems)), top_len - 1]
+    result = np.concatenate([column_sum % 10, np.zeros((len(problems), 1), dtype=top.dtype)], axis=1)
+    result[np.arange(len(problems)), top_len] = final_carry
+    sols = _result_strings(result, top_len + (final_carry != 0))
+
+    header = TEMPLATES[verbosity]["add_header"].format
+    answer = TEMPLATES[verbosity]["answer"].format
+    outputs = []
+    for row, (t, b), n, sol in zip(lines, problems, top_len.tolist(), sols):
+        prompt = header(top=t, bot=b) + "\n".join(row[:n].tolist()) + answer(sol=sol)
+        outputs.append((f"{t} + {b}", prompt, sol))
+    return outputs
+
+
+def batch_subtract_prompts(problems, verbosity="full"):
+    """
+    Builds make_subtract_prompt outputs for a whole list of (top, bottom) pairs at once,
+    using subtract_borrows and a table of step lines like batch_add_prompts.
+    """
+    tops = [top for top, _ in problems]
+    bots = [bot for _, bot in problems]
+    top, top_len = digit_matrix(tops)
+    width = top.shape[1]
+    bot, _ = digit_matrix(bots, width)
+
+    borrow_in, column_sub, _ = subtract_borrows(top, bot)
+    columns = np.arange(width)
+    lines = _subtract_lines(width, verbosity)[columns[None, :], top, bot, borrow_in]
+    sols = _result_strings(column_sub, top_len)
+
+    header = TEMPLATES[verbosity]["sub_header"].format
+    answer = TEMPLATES[verbosity]["answer"].format
+    outputs = []
+    for row, (t, b), n, sol in zip(lines, problems, top_len.tolist(), sols):
+        prompt = header(top=t, bot=b) + "\n".join(row[:n].tolist()) + answer(sol=sol)
+        outputs.append((f"{t} - {b}", prompt, sol))
+    return outputs
+
+
+BATCH_OPERATIONS = {
+    "+": batch_add_prompts,
+    "-": batch_subtract_prompts,
+}
+
+
+def iter_batched_examples(
+    op, num, max_digits, start_id=1, rng=None, batch_size=SAMPLE_BATCH, options=None
+):
+    """
+    Yields num examples for one operation like iter_problem_examples, sampling pairs with
+    iter_sampled_pairs. Addition and subtraction are rendered a batch at a time; the other
+    operations, or any builder options other than verbosity, fall back to the per example builders.
+    """
+    options = options or {}
+    build_batch = BATCH_OPERATIONS.get(op) if set(options) <= {"verbosity"} else None
+    make_prompt = OPERATIONS[op]
+    question_id = start_id
+    sampled = iter_sampled_pairs(num, max_digits, rng, batch_size)
+    while True:
+        pairs = list(islice(sampled, batch_size))
+        if not pairs:
+            break
+        if build_batch is not None:
+            outputs = build_batch(pairs, **options)
+        else:
+            outputs = [make_prompt(pair, **options) for pair in pairs]
+        for q, a, s in outputs:
+            yield {"question": q, "answer": a, "question_id": question_id}
+            question_id += 1
@@ -0,0 +1,211 @@
+"""
+Throughput benchmark for the mathnet generators.
+
+Times every prompt builder (and the basic arithmetic table) on pre-sampled problems for a
+range of operand widths, and reports examples per second, bytes per second of the JSONL
+lines they become and the peak RSS of the process. Every case runs in a fresh process, so
+its peak RSS is its own. Results are written as JSON and can be compared with a stored
+baseline; a case is flagged as a regression when its throughput drops, or its peak RSS
+grows, by more than the tolerance.
+
+    python bench.py --out bench.json
+    python bench.py --baseline bench_baseline.json      # exits with status 1 on a regression
+    python bench.py --save-baseline bench_baseline.json
+"""
+
+import json
+import platform
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from mathnet_dset import GENERATOR_VERSION, OPERATIONS, basic_arithmetic, make_number_pairs
+
+
+# (op, max_digits or up_to for "basic", examples)
+DEFAULT_CASES = [
+    ("basic", 15, 900),
+    ("basic", 30, 3600),
+    ("+", 2, 20_000),
+    ("+", 5, 20_000),
+    ("+", 10, 10_000),
+    ("+", 20, 5_000),
+    ("-", 2, 20_000),
+    ("-", 5, 20_000),
+    ("-", 10, 10_000),
+    ("-", 20, 5_000),
+    ("*", 2, 10_000),
+    ("*", 3, 5_000),
+    ("*", 5, 2_000),
+    ("*", 8, 1_000),
+    ("/", 2, 10_000),
+    ("/", 3, 5_000),
+    ("/", 5, 2_000),
+    ("/", 8, 1_000),
+]
+
+
+def case_name(op, width):
+    return f"{op}:{width}"
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far, in MiB
+    """
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def line_bytes(example):
+    return len((json.dumps(example, ensure_ascii=False) + "\n").encode("utf-8"))
+
+
+def run_case(op, width, num, repeats=3, seed=0, options=None):
+    """
+    Times one case and returns its result dict. Sampling is done up front so only the
+    builder is timed; the best of repeats runs is kept.
+    """
+    options = options or {}
+    if op == "basic":
+        build = lambda: basic_arithmetic(width)
+    else:
+        make_prompt = OPERATIONS[op]
+        pairs = make_number_pairs(num, width, random.Random(seed))
+        build = lambda: [make_prompt(pair, **options) for pair in pairs]
+
+    rss_before = peak_rss_mb()
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        examples = build()
+        best = min(best, time.perf_counter() - start)
+
+    if op == "basic":
+        num_bytes = sum(line_bytes(example) for example in examples)
+    else:
+        num_bytes = sum(
+            line_bytes({"question": q, "answer": a, "question_id": i + 1}) for i, (q, a, _) in enumerate(examples)
+        )
+    return {
+        "name": case_name(op, width),
+        "op": op,
+        "width": width,
+        "examples": len(examples),
+        "seconds": best,
+        "examples_per_s": len(examples) / best,
+        "bytes_per_s": num_bytes / best,
+        "bytes_per_example": num_bytes / len(examples),
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_growth_mb": peak_rss_mb() - rss_before,
+    }
+
+
+def run_benchmarks(cases=DEFAULT_CASES, repeats=3, seed=0, options=None, scale=1.0):
+    """
+    Runs every case in its own fresh process and returns the results document.
+    options maps an operation to the keyword arguments for its prompt builder.
+    scale multiplies the number of examples of every case.
+    """
+    options = options or {}
+    results = []
+    for op, width, num in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+            result = pool.submit(
+                run_case, op, width, max(1, int(num * scale)), repeats, seed, options.get(op)
+            ).result()
+        print(
+            f"{result['name']:>8}  {result['examples_per_s']:>12,.0f} ex/s  "
+            f"{result['bytes_per_s'] / 2**20:>8.2f} MiB/s  {result['peak_rss_mb']:>7.1f} MiB peak"
+        )
+        results.append(result)
+    return {
+        "meta": {
+            "generator_version": GENERATOR_VERSION,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "repeats": repeats,
+            "seed": seed,
+            "options": options,
+            "scale": scale,
+        },
+        "results": results,
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Returns a list of regressions of results against baseline, cases missing from either
+    side are skipped. Throughput regresses when it falls below (1 - tolerance) times the
+    baseline, peak RSS when it grows above (1 + tolerance) times the baseline.
+    """
+    previous = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        base = previous.get(result["name"])
+        if base is None:
+            continue
+        if result["examples_per_s"] < (1 - tolerance) * base["examples_per_s"]:
+            regressions.append(
+                {
+                    "name": result["name"],
+                    "metric": "examples_per_s",
+                    "baseline": base["examples_per_s"],
+                    "current": result["examples_per_s"],
+                }
+            )
+        if result["peak_rss_mb"] > (1 + tolerance) * base["peak_rss_mb"]:
+            regressions.append(
+                {
+                    "name": result["name"],
+                    "metric": "peak_rss_mb",
+                    "baseline": base["peak_rss_mb"],
+                    "current": result["peak_rss_mb"],
+                }
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the mathnet generators")
+    parser.add_argument("--out", default=None, help="write the results JSON here")
+    parser.add_argument("--baseline", default=None, help="baseline JSON to check for regressions")
+    parser.add_argument("--save-baseline", default=None, help="write the results as a new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown or RSS growth")
+    parser.add_argument("--ops", default=None, help="only run these operations, e.g. '+-' or 'basic'")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the examples of every case")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    cases = DEFAULT_CASES
+    if args.ops is not None:
+        ops = args.ops.replace("basic", "")
+        cases = [case for case in cases if case[0] in ops or (case[0] == "basic" and "basic" in args.ops)]
+
+    results = run_benchmarks(cases, repeats=args.repeats, seed=args.seed, scale=args.scale)
+    for path in (args.out, args.save_baseline):
+        if path is not None:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(results, file, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(
+                f"REGRESSION {regression['name']} {regression['metric']}: "
+                f"{regression['baseline']:,.1f} -> {regression['current']:,.1f}"
+            )
+        if regressions:
+            raise SystemExit(1)
+        print(f"No regressions against {args.baseline}")
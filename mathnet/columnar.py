@@ -0,0 +1,199 @@
+"""
+Memory mapped columnar storage for mathnet datasets.
+
+A columnar dataset is a directory with one set of raw files per column and a meta.json:
+    text columns:    {name}.data    utf-8 bytes of every row back to back
+                     {name}.offsets int64 row boundaries, n + 1 of them
+    integer columns: {name}.values  int64, one per row
+Opening a dataset only maps these files, so it is near instant at any size, and rows are
+read straight from the page cache in any order. Writing streams rows to disk one at a time.
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+META_NAME = "meta.json"
+
+# rows buffered per column before their offsets or values are flushed to disk
+FLUSH_ROWS = 65536
+
+
+class ColumnarWriter:
+    """
+    Streams examples into a columnar dataset directory. Column types are taken from the
+    first example: ints become integer columns and everything else is stored as text.
+    close() (or leaving the with block) finishes the files and writes meta.json.
+    """
+
+    def __init__(self, out_dir, columns=None):
+        self.out_dir = out_dir
+        self.columns = list(columns) if columns is not None else None
+        self.types = {}
+        self.num_rows = 0
+        self._files = {}
+        self._buffers = {}
+        self._sizes = {}
+        self.meta = None
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.out_dir, name)
+
+    def _open(self, example):
+        if self.columns is None:
+            self.columns = list(example)
+        for column in self.columns:
+            if isinstance(example[column], int):
+                self.types[column] = "int64"
+                self._files[column] = (open(self._path(f"{column}.values"), "wb"),)
+            else:
+                self.types[column] = "text"
+                data = open(self._path(f"{column}.data"), "wb")
+                offsets = open(self._path(f"{column}.offsets"), "wb")
+                self._files[column] = (data, offsets)
+                self._sizes[column] = 0
+            self._buffers[column] = [0] if self.types[column] == "text" else []
+
+    def _flush(self):
+        for column, buffer in self._buffers.items():
+            if not buffer:
+                continue
+            np.asarray(buffer, dtype=np.int64).tofile(self._files[column][-1])
+            buffer.clear()
+
+    def write(self, example):
+        if not self._files:
+            self._open(example)
+        for column in self.columns:
+            value = example[column]
+            if self.types[column] == "int64":
+                self._buffers[column].append(value)
+            else:
+                encoded = str(value).encode("utf-8")
+                self._files[column][0].write(encoded)
+                self._sizes[column] += len(encoded)
+                self._buffers[column].append(self._sizes[column])
+        self.num_rows += 1
+        if self.num_rows % FLUSH_ROWS == 0:
+            self._flush()
+
+    def write_all(self, examples):
+        for example in examples:
+            self.write(example)
+        return self
+
+    def close(self):
+        if self.meta is not None:
+            return self.meta
+        self._flush()
+        for files in self._files.values():
+            for file in files:
+                file.close()
+        self.meta = {"num_rows": self.num_rows, "columns": self.types}
+        with open(self._path(META_NAME), "w", encoding="utf-8") as file:
+            json.dump(self.meta, file, indent=4)
+        return self.meta
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def write_columnar(examples, out_dir, columns=None):
+    """
+    Writes an iterable of examples to a columnar dataset and returns its meta
+    """
+    with ColumnarWriter(out_dir, columns) as writer:
+        writer.write_all(examples)
+    return writer.close()
+
+
+def _map(path, dtype):
+    # np.memmap refuses empty files, which a dataset with no rows or empty strings can have
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class ColumnarDataset:
+    """
+    Read only, memory mapped view of a columnar dataset. Supports len(), integer indexing
+    (returns a dict), slices and index arrays (return a list of dicts) for shuffling.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_NAME), encoding="utf-8") as file:
+            meta = json.load(file)
+        self.num_rows = meta["num_rows"]
+        self.types = meta["columns"]
+        self.columns = list(self.types)
+        self._data = {}
+        self._offsets = {}
+        self._values = {}
+        for column, kind in self.types.items():
+            if kind == "int64":
+                self._values[column] = _map(os.path.join(path, f"{column}.values"), np.int64)
+            else:
+                self._data[column] = _map(os.path.join(path, f"{column}.data"), np.uint8)
+                self._offsets[column] = _map(os.path.join(path, f"{column}.offsets"), np.int64)
+
+    def __len__(self):
+        return self.num_rows
+
+    def raw(self, index, column):
+        """
+        Returns the bytes of one text cell as a memoryview into the mapped file, without copying
+        """
+        offsets = self._offsets[column]
+        return memoryview(self._data[column][offsets[index] : offsets[index + 1]])
+
+    def value(self, index, column):
+        if column in self._values:
+            return int(self._values[column][index])
+        return bytes(self.raw(index, column)).decode("utf-8")
+
+    def row(self, index):
+        if index < 0:
+            index += self.num_rows
+        if not 0 <= index < self.num_rows:
+            raise IndexError(index)
+        return {column: self.value(index, column) for column in self.columns}
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.row(i) for i in range(*key.indices(self.num_rows))]
+        if isinstance(key, (list, np.ndarray)):
+            return [self.row(int(i)) for i in key]
+        return self.row(key)
+
+    def __iter__(self):
+        for i in range(self.num_rows):
+            yield self.row(i)
+
+    def column(self, name):
+        """
+        Returns an int64 column as its mapped array, or a text column as a list of str
+        """
+        if name in self._values:
+            return self._values[name]
+        return [self.value(i, name) for i in range(self.num_rows)]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from shards import iter_shards
+
+    parser = argparse.ArgumentParser(description="Convert a JSONL shard directory to a columnar dataset")
+    parser.add_argument("shards", help="shard directory written by mathnet_dset.py")
+    parser.add_argument("out", help="output directory for the columnar dataset")
+    args = parser.parse_args()
+
+    meta = write_columnar(iter_shards(args.shards), args.out)
+    print(f"Wrote {meta['num_rows']} rows with columns {meta['columns']} to {args.out}")
@@ -0,0 +1,137 @@
+"""
+Streaming, memory bounded deduplication of generated problems.
+
+Problems are keyed on their question text, which holds (top, op, bottom) exactly. Keys seen
+so far go into a Bloom filter whose size is fixed up front, so memory stays at the cap no
+matter how many examples stream through. A Bloom filter never misses a repeat but can,
+rarely, flag a new problem as seen; estimated_false_positive_rate reports how likely that
+is at the current fill. Held-out problems are kept in an exact set so nothing that
+collides with a test set slips through.
+"""
+
+import hashlib
+import math
+
+from shards import ShardWriter, iter_shards
+
+
+def problem_key(example):
+    """
+    Returns the 16 byte digest identifying an example's problem, from its question
+    """
+    question = " ".join(example["question"].split())
+    return hashlib.blake2b(question.encode("utf-8"), digest_size=16).digest()
+
+
+class BloomFilter:
+    """
+    A fixed size Bloom filter over 16 byte keys. Uses max_bytes of memory and picks the
+    number of hash functions for expected_items, or 7 if that is not known.
+    """
+
+    MAX_HASHES = 16
+
+    def __init__(self, max_bytes=64 * 2**20, expected_items=None):
+        self.num_bits = max_bytes * 8
+        self.bits = bytearray(max_bytes)
+        if expected_items:
+            optimal = round(self.num_bits / expected_items * math.log(2))
+            self.num_hashes = min(self.MAX_HASHES, max(1, optimal))
+        else:
+            self.num_hashes = 7
+        self.num_items = 0
+
+    def _positions(self, key):
+        # double hashing: the i-th position is h1 + i * h2
+        h1 = int.from_bytes(key[:8], "little")
+        h2 = int.from_bytes(key[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        """
+        Adds key and returns True if it was (probably) not in the filter before
+        """
+        new = False
+        bits = self.bits
+        for position in self._positions(key):
+            byte, bit = position >> 3, 1 << (position & 7)
+            if not bits[byte] & bit:
+                bits[byte] |= bit
+                new = True
+        if new:
+            self.num_items += 1
+        return new
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def estimated_false_positive_rate(self):
+        """
+        Probability that a new key is wrongly reported as seen, at the current fill
+        """
+        return (1 - math.exp(-self.num_hashes * self.num_items / self.num_bits)) ** self.num_hashes
+
+
+class Deduplicator:
+    """
+    Drops repeated problems and held-out collisions from a stream of examples.
+    heldout is any iterable of examples (e.g. iter_shards of a test set) that must never
+    appear in the output. Counts are kept in seen, duplicates and heldout_hits.
+    """
+
+    def __init__(self, max_bytes=64 * 2**20, expected_items=None, heldout=()):
+        self.index = BloomFilter(max_bytes, expected_items)
+        self.heldout = {problem_key(example) for example in heldout}
+        self.seen = 0
+        self.duplicates = 0
+        self.heldout_hits = 0
+
+    def keep(self, example):
+        """
+        Returns True if the example is new and not held out, recording it as seen
+        """
+        self.seen += 1
+        key = problem_key(example)
+        if key in self.heldout:
+            self.heldout_hits += 1
+            return False
+        if not self.index.add(key):
+            self.duplicates += 1
+            return False
+        return True
+
+    def filter(self, examples):
+        """
+        Yields only the examples that keep() accepts
+        """
+        for example in examples:
+            if self.keep(example):
+                yield example
+
+    def duplicate_rate(self):
+        return self.duplicates / self.seen if self.seen else 0.0
+
+    def report(self):
+        """
+        Summary of what was dropped, as a dict
+        """
+        return {
+            "seen": self.seen,
+            "kept": self.seen - self.duplicates - self.heldout_hits,
+            "duplicates": self.duplicates,
+            "heldout_hits": self.heldout_hits,
+            "duplicate_rate": self.duplicate_rate(),
+            "estimated_false_positive_rate": self.index.estimated_false_positive_rate(),
+        }
+
+
+def dedup_shards(in_dir, out_dir, deduplicator, prefix="mathnet", max_bytes=64 * 2**20, compression=None):
+    """
+    Streams a finished shard directory (e.g. the output of generate_parallel) through
+    deduplicator into new shards in out_dir and returns the ShardWriter. Examples keep their
+    order, so the result does not depend on how many workers generated in_dir.
+    """
+    with ShardWriter(out_dir, prefix=prefix, max_bytes=max_bytes, compression=compression) as writer:
+        writer.write_all(deduplicator.filter(iter_shards(in_dir)))
+    return writer
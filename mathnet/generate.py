@@ -0,0 +1,274 @@
+"""
+Parallel mathnet generation.
+
+The job is split into shards of a fixed number of examples before any work starts. Every
+shard gets its own seed derived from the base seed, the operation and the shard number,
+so each shard's bytes depend only on those inputs and never on how many workers ran or in
+which order they finished. Workers write their shard files directly and only send the
+manifest entry back.
+
+Shard files are named by a hash of their inputs and the generator version (task_key) and
+logged to progress.jsonl as they finish, so rerunning the same command resumes an
+interrupted run and a changed config only regenerates the shards it affects.
+"""
+
+import hashlib
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from mathnet_dset import (
+    DEFAULT_MIX,
+    GENERATOR_VERSION,
+    OPERATIONS,
+    iter_basic_arithmetic,
+    iter_number_pairs,
+    iter_problem_examples,
+)
+from shards import EXTENSIONS, write_manifest, write_shard
+
+
+PROGRESS_NAME = "progress.jsonl"
+
+# fixed problems every builder is run on to detect changes to its output
+PROBE_PAIRS = list(iter_number_pairs(32, 6, random.Random(0))) + [("100", "99"), ("999999", "1"), ("10", "10")]
+
+
+def derive_seed(seed, *keys):
+    """
+    Derives a 64 bit seed from a base seed and any number of keys. Stable across runs
+    and Python versions, unlike hash().
+    """
+    digest = hashlib.sha256(repr((seed,) + keys).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+def op_fingerprint(op, options=None):
+    """
+    Hash of what an operation's builder produces for PROBE_PAIRS with the given options.
+    Changes whenever a template or the trace logic of that operation changes.
+    """
+    cache_key = json.dumps([op, options or {}], sort_keys=True)
+    if cache_key not in _FINGERPRINTS:
+        _FINGERPRINTS[cache_key] = _fingerprint(op, options)
+    return _FINGERPRINTS[cache_key]
+
+
+_FINGERPRINTS = {}
+
+
+def _fingerprint(op, options):
+    digest = hashlib.sha256()
+    if op == "basic":
+        for example in iter_basic_arithmetic(4):
+            digest.update(json.dumps(example).encode("utf-8"))
+        return digest.hexdigest()
+    for pair in PROBE_PAIRS:
+        digest.update(json.dumps(OPERATIONS[op](pair, **(options or {}))).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def task_key(task, compression=None):
+    """
+    Content address of a shard: a hash of the generator version and fingerprint and every
+    input of the task. Two tasks with the same key write the same bytes.
+    """
+    parts = {
+        "version": GENERATOR_VERSION,
+        "fingerprint": op_fingerprint(task["op"], task.get("options")),
+        "compression": compression,
+        **{name: value for name, value in task.items() if name != "index"},
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def plan_shards(
+    mix=DEFAULT_MIX, up_to=15, seed=0, shard_examples=100_000, sampler="random", options=None
+):
+    """
+    Splits a generation job into a list of shard tasks. Each task is a dict holding
+    everything a worker needs to write that shard on its own.
+    options maps an operation to the keyword arguments for its prompt builder
+    sampler is "random" for iter_number_pairs or "numpy" for the vectorized sampler and
+    batched trace rendering in batched.py
+    """
+    if sampler not in ("random", "numpy"):
+        raise ValueError(f"Unknown sampler {sampler!r}, expected 'random' or 'numpy'")
+    options = options or {}
+    tasks = []
+    question_count = 0
+    if up_to > 0:
+        num = 4 * up_to**2
+        tasks.append({"op": "basic", "num": num, "up_to": up_to, "start_id": 1})
+        question_count += num
+
+    for entry, (op, num, max_digits) in enumerate(mix):
+        for part, start in enumerate(range(0, num, shard_examples)):
+            count = min(shard_examples, num - start)
+            tasks.append(
+                {
+                    "op": op,
+                    "num": count,
+                    "max_digits": max_digits,
+                    # the mix entry keeps repeated (op, max_digits) entries apart
+                    "seed": derive_seed(seed, "shard", entry, op, max_digits, part),
+                    "sampler": sampler,
+                    "options": options.get(op, {}),
+                    "start_id": question_count + start + 1,
+                }
+            )
+        question_count += num
+
+    for index, task in enumerate(tasks):
+        task["index"] = index
+    return tasks
+
+
+def iter_task_examples(task):
+    """
+    Yields the examples of one shard task
+    """
+    if task["op"] == "basic":
+        return iter_basic_arithmetic(task["up_to"])
+
+    if task["sampler"] == "numpy":
+        from batched import iter_batched_examples
+
+        return iter_batched_examples(
+            task["op"],
+            task["num"],
+            task["max_digits"],
+            start_id=task["start_id"],
+            rng=task["seed"],
+            options=task["options"],
+        )
+
+    return iter_problem_examples(
+        task["op"],
+        task["num"],
+        task["max_digits"],
+        start_id=task["start_id"],
+        rng=random.Random(task["seed"]),
+        options=task["options"],
+    )
+
+
+def shard_name(task, prefix="mathnet", compression=None):
+    return f"{prefix}-{task['key'][:16]}{EXTENSIONS[compression]}"
+
+
+def run_task(task, out_dir, prefix="mathnet", compression=None):
+    """
+    Writes the shard for one task and returns its manifest entry. The shard is written
+    under a temporary name and renamed once complete, so a killed worker never leaves a
+    partial shard behind under its final name.
+    """
+    name = shard_name(task, prefix, compression)
+    entry = write_shard(out_dir, name + ".tmp", iter_task_examples(task), compression)
+    os.replace(os.path.join(out_dir, name + ".tmp"), os.path.join(out_dir, name))
+    return {**entry, "file": name, "key": task["key"]}
+
+
+def _run_task_star(args):
+    return run_task(*args)
+
+
+def read_progress(out_dir):
+    """
+    Entries of every shard a previous run finished, by key, skipping any whose file is gone
+    """
+    path = os.path.join(out_dir, PROGRESS_NAME)
+    if not os.path.exists(path):
+        return {}
+    done = {}
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of an interrupted run can be cut short
+                continue
+            if os.path.exists(os.path.join(out_dir, entry["file"])):
+                done[entry["key"]] = entry
+    return done
+
+
+def generate_parallel(
+    out_dir,
+    mix=DEFAULT_MIX,
+    up_to=15,
+    seed=0,
+    shard_examples=100_000,
+    workers=None,
+    prefix="mathnet",
+    compression=None,
+    sampler="random",
+    options=None,
+    resume=True,
+):
+    """
+    Generates a dataset into out_dir using a pool of worker processes and writes the manifest.
+    The output is byte identical for any number of workers. workers=None uses every core and
+    workers=1 runs in this process.
+
+    Shards are content addressed by task_key and every finished shard is logged to
+    progress.jsonl as soon as it is done. With resume, a rerun skips every shard whose key is
+    already in the log, so only shards whose inputs changed are regenerated and an
+    interrupted run continues from the shards it had finished. Shards from earlier runs that
+    the new plan no longer uses are deleted.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = plan_shards(
+        mix,
+        up_to=up_to,
+        seed=seed,
+        shard_examples=shard_examples,
+        sampler=sampler,
+        options=options,
+    )
+    for task in tasks:
+        task["key"] = task_key(task, compression)
+
+    done = read_progress(out_dir) if resume else {}
+    todo = [task for task in tasks if task["key"] not in done]
+    print(f"{len(tasks) - len(todo)} shards up to date, generating {len(todo)}")
+
+    progress = open(os.path.join(out_dir, PROGRESS_NAME), "a" if resume else "w", encoding="utf-8")
+    with progress:
+
+        def record(entry):
+            done[entry["key"]] = entry
+            progress.write(json.dumps(entry) + "\n")
+            progress.flush()
+
+        jobs = [(task, out_dir, prefix, compression) for task in todo]
+        if workers == 1:
+            for job in jobs:
+                record(_run_task_star(job))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_run_task_star, job) for job in jobs]
+                for future in as_completed(futures):
+                    record(future.result())
+
+    # the manifest follows task order, so it never depends on completion order
+    shards = [done[task["key"]] for task in tasks]
+
+    used = {shard["file"] for shard in shards}
+    for entry in done.values():
+        if entry["file"] not in used:
+            os.remove(os.path.join(out_dir, entry["file"]))
+    with open(os.path.join(out_dir, PROGRESS_NAME), "w", encoding="utf-8") as file:
+        for shard in shards:
+            file.write(json.dumps(shard) + "\n")
+
+    return write_manifest(
+        out_dir,
+        shards,
+        compression,
+        seed=seed,
+        shard_examples=shard_examples,
+        sampler=sampler,
+        options=options or {},
+    )
@@ -2,8 +2,8 @@
 This file contains a series of functions for creating txt datasets of question answer pairs separated by a ;
 """
 
-import json
 import random
+import re
 
 
 BASES = [
@@ -27,345 +27,827 @@ BASES = [
     "hundred quadrillions",
 ]
 
+# Wording of every trace line for each verbosity level. "full" is the original prose,
+# "short" keeps the place names but drops the explanations and "compact" writes each
+# column as bare d+d+c=s notation. Every level ends on "The answer is" where the full one does.
+TEMPLATES = {
+    "full": {
+        "answer": "\nThe answer is {sol}",
+        "add_header": "Add {top} and {bot} step by step:\n",
+        "add_step": "Adding the {place}: {top_digit} + {bot_digit} + {carry} = {column_sum} (carry {new_carry} to the next pair, and we write down {remainder} at the {place} place)",
+        "add_step_past": "Adding the {place}: {top_digit} + {bot_digit} + {carry} = {column_sum} (There are no digits in the smaller number greater greater than the {place}, so we write down the {remainder} from the {place} spot from the top number)",
+        "sub_header": "Subtract {bot} from {top} step by step:\n",
+        "sub_step": "Subtracting the {place}: {top_digit} - {bot_digit} - previous borrow {borrow} = {column_sub} (place the {column_sub} at the {place} place)",
+        "mult_header": "Multiply {top} and {bot} step by step:\n",
+        "row_start": "Multiplying {top} by the {bot_digit} in the {place} place",
+        "row_step": "{top_digit} * {bot_digit} + {carry} = {mult} (carry {new_carry}, remainder {remainder})",
+        "row_end": "Multiplying {top} by the {bot_digit} in the {place} place yields {intermediate}\n",
+        "sum_start": "Adding all of our intermediate solutions together {terms}:\n",
+        "sum_next": "After adding the intermediates now are {terms}",
+        "sum_next_pairs": "After adding the intermediates in pairs now are {terms}",
+        "sum_done": "Adding all of the intermediates results in the final solution of: {total}",
+        "sum_column": "Adding the {place}: {terms} + {carry} = {column_sum} (carry {new_carry} to the next column, and we write down {remainder} at the {place} place)",
+        "column_joiner": " + ",
+        "div_header": "How many times does {bot} fit into {top}. Divide {top} by {bot} step by step:\n",
+        "div_first": "Start with the first digit {digit}: {divisor} fits into {current} {quotient_digit} times, {divisor} * {quotient_digit} = {product}, {current} - {product} = {new_remainder} (write {quotient_digit} in the quotient)",
+        "div_step": "Bring down the {digit} next to the remainder {remainder} to get {current}: {divisor} fits into {current} {quotient_digit} times, {divisor} * {quotient_digit} = {product}, {current} - {product} = {new_remainder} (write {quotient_digit} in the quotient)",
+        "div_answer": "\nThus, the quotient is {quotient} and the remainder is {remainder}\nThe answer is {quotient}R{remainder}",
+    },
+    "short": {
+        "answer": "\nThe answer is {sol}",
+        "add_header": "Add {top} and {bot}:\n",
+        "add_step": "{place}: {top_digit} + {bot_digit} + {carry} = {column_sum}, write {remainder} carry {new_carry}",
+        "add_step_past": "{place}: {top_digit} + {bot_digit} + {carry} = {column_sum}, write {remainder} carry {new_carry}",
+        "sub_header": "Subtract {bot} from {top}:\n",
+        "sub_step": "{place}: {borrowed_top} - {bot_digit} - {borrow_in} = {column_sub}, borrow {borrow}",
+        "mult_header": "Multiply {top} and {bot}:\n",
+        "row_start": "{top} * {bot_digit} ({place}):",
+        "row_step": "{top_digit} * {bot_digit} + {carry} = {mult}, write {remainder} carry {new_carry}",
+        "row_end": "{top} * {bot_digit} ({place}) = {intermediate}\n",
+        "sum_start": "Add {terms}:\n",
+        "sum_next": "Now {terms}",
+        "sum_next_pairs": "Now {terms}",
+        "sum_done": "Total: {total}",
+        "sum_column": "{place}: {terms} + {carry} = {column_sum}, write {remainder} carry {new_carry}",
+        "column_joiner": " + ",
+        "div_header": "Divide {top} by {bot}:\n",
+        "div_first": "{current} / {divisor} = {quotient_digit}, {current} - {product} = {new_remainder}",
+        "div_step": "bring down {digit}: {current} / {divisor} = {quotient_digit}, {current} - {product} = {new_remainder}",
+        "div_answer": "\nQuotient {quotient} remainder {remainder}\nThe answer is {quotient}R{remainder}",
+    },
+    "compact": {
+        "answer": "\nThe answer is {sol}",
+        "add_header": "{top}+{bot}:\n",
+        "add_step": "{top_digit}+{bot_digit}+{carry}={column_sum}",
+        "add_step_past": "{top_digit}+{bot_digit}+{carry}={column_sum}",
+        "sub_header": "{top}-{bot}:\n",
+        "sub_step": "{borrowed_top}-{bot_digit}-{borrow_in}={column_sub}",
+        "mult_header": "{top}*{bot}:\n",
+        "row_start": "{top}*{bot_digit}:",
+        "row_step": "{top_digit}*{bot_digit}+{carry}={mult}",
+        "row_end": "={intermediate}",
+        "sum_start": "{terms}:",
+        "sum_next": "={terms}",
+        "sum_next_pairs": "={terms}",
+        "sum_done": "={total}",
+        "sum_column": "{terms}+{carry}={column_sum}",
+        "column_joiner": "+",
+        "div_header": "{top}/{bot}:\n",
+        "div_first": "{current}/{divisor}={quotient_digit} r{new_remainder}",
+        "div_step": "{current}/{divisor}={quotient_digit} r{new_remainder}",
+        "div_answer": "\nThe answer is {quotient}R{remainder}",
+    },
+}
+
+VERBOSITY = list(TEMPLATES)
+
+
+# Names of every third place after the thousands, used to name places past BASES
+SCALES = [
+    "thousands",
+    "millions",
+    "billions",
+    "trillions",
+    "quadrillions",
+    "quintillions",
+    "sextillions",
+    "septillions",
+    "octillions",
+    "nonillions",
+    "decillions",
+    "undecillions",
+    "duodecillions",
+    "tredecillions",
+    "quattuordecillions",
+    "quindecillions",
+    "sexdecillions",
+    "septendecillions",
+    "octodecillions",
+    "novemdecillions",
+    "vigintillions",
+]
+
+
+def place_name(i):
+    """
+    Returns the name of the i-th place counting from the ones (i=0), for any i
+    """
+    if i < len(BASES):
+        return BASES[i]
+    group, within = divmod(i, 3)
+    if group > len(SCALES):
+        return f"10^{i}s"
+    return ("", "ten ", "hundred ")[within] + SCALES[group - 1]
+
+
+def place_names(n):
+    """
+    Returns the names of the first n places
+    """
+    return [place_name(i) for i in range(n)]
+
+
+def to_digits(number):
+    """
+    Converts a digit string into a list of ints, least significant digit first
+    """
+    return [ord(c) - 48 for c in reversed(number)]
+
+
+def from_digits(digits):
+    """
+    Converts a list of ints, least significant digit first, back into a digit string.
+    Leading zeros are kept so callers can decide how to present them.
+    """
+    return "".join(map(str, reversed(digits)))
+
+
+def add_columns(top_digits, bot_digits):
+    """
+    Adds two digit lists column by column in a single linear pass.
+    Returns a list of (top_digit, bot_digit, carry_in, column_sum, carry_out) per column
+    of top_digits, the result digits (least significant first) and the final carry.
+    """
+    columns = []
+    result = []
+    carry = 0
+    n_bot = len(bot_digits)
+    for i, top_digit in enumerate(top_digits):
+        bot_digit = bot_digits[i] if i < n_bot else 0
+        column_sum = top_digit + bot_digit + carry
+        new_carry = column_sum // 10
+        columns.append((top_digit, bot_digit, carry, column_sum, new_carry))
+        result.append(column_sum % 10)
+        carry = new_carry
+    return columns, result, carry
+
+
+def subtract_columns(top_digits, bot_digits):
+    """
+    Subtracts bot_digits from top_digits (top >= bot) column by column in a single linear pass.
+    Returns a list of (top_digit, bot_digit, borrow_out, digit) per column of top_digits
+    and the result digits (least significant first).
+    """
+    columns = []
+    result = []
+    borrow = 0
+    n_bot = len(bot_digits)
+    for i, top_digit in enumerate(top_digits):
+        bot_digit = bot_digits[i] if i < n_bot else 0
+        column_sub = top_digit - bot_digit - borrow
+        if column_sub < 0:
+            column_sub += 10
+            borrow = 1
+        else:
+            borrow = 0
+        columns.append((top_digit, bot_digit, borrow, column_sub))
+        result.append(column_sub)
+    return columns, result
+
+
+def multiply_row(top_digits, digit):
+    """
+    Multiplies a digit list by a single digit in a single linear pass.
+    Returns a list of (top_digit, carry_in, product, carry_out) per column, the result
+    digits (least significant first) and the final carry.
+    """
+    columns = []
+    result = []
+    carry = 0
+    for top_digit in top_digits:
+        mult = top_digit * digit + carry
+        new_carry = mult // 10
+        columns.append((top_digit, carry, mult, new_carry))
+        result.append(mult % 10)
+        carry = new_carry
+    return columns, result, carry
+
+
+BASIC_OPERANDS = ["+", "-", "*", "/"]
+
+
+def basic_arithmetic_example(index, up_to=15):
+    """
+    Returns entry index (0 based) of the basic arithmetic table directly, without building the table
+    """
+    op_index, rest = divmod(index, up_to**2)
+    i, j = divmod(rest, up_to)
+    i += 1
+    j += 1
+    op = BASIC_OPERANDS[op_index]
+    if op == "+":
+        solution = i + j
+    elif op == "-":
+        solution = i - j
+    elif op == "*":
+        solution = i * j
+    elif op == "/":
+        if j != 0:
+            solution = i / j
+        else:
+            solution = "can not divide by 0"
+
+    question = f"{i} {op} {j}"
+    answer = str(solution) if isinstance(solution, int) else solution
+    return {
+        "question": question,
+        "answer": str(answer),
+        "question_id": index + 1,
+    }
+
+
+def iter_basic_arithmetic(up_to=15):
+    """
+    Yields basic arithmetic operations one at a time, numbered from question_id 1
+    """
+    for index in range(len(BASIC_OPERANDS) * up_to**2):
+        yield basic_arithmetic_example(index, up_to)
+
 
 def basic_arithmetic(up_to=15):
     """
-    Saves basic arithmetic operations to a JSON file
-    """
-    operands = ["+", "-", "*", "/"]
-    examples = []
-    counter = 1
-    for op in operands:
-        for i in range(1, up_to + 1):
-            for j in range(1, up_to + 1):
-                if op == "+":
-                    solution = i + j
-                elif op == "-":
-                    solution = i - j
-                elif op == "*":
-                    solution = i * j
-                elif op == "/":
-                    if j != 0:
-                        solution = i / j
-                    else:
-                        solution = "can not divide by 0"
-
-                question = f"{i} {op} {j}"
-                answer = str(solution) if isinstance(solution, int) else solution
-                examples.append(
-                    {
-                        "question": question,
-                        "answer": str(answer),
-                        "question_id": counter,
-                    }
-                )
-                counter += 1
-
-    return examples
-
-
-def make_number_pairs(num=100, max_digits=3):
+    Returns the basic arithmetic operations as a list
     """
-    Generates a list of tuples of integer pairs. Right number is bigger
-    Returns a list of strings for easier digit wise operations
+    return list(iter_basic_arithmetic(up_to))
+
+
+def iter_number_pairs(num=100, max_digits=3, rng=random):
+    """
+    Yields tuples of integer pairs one at a time. Left number is bigger
+    Yields strings for easier digit wise operations
+    rng can be a random.Random instance, by default the global random state is used
     """
-    problems = []
     for _ in range(num):
-        digits_top = max(2, random.randint(1, max_digits))
-        digits_bottom = min(digits_top, random.randint(1, max_digits))
+        digits_top = max(2, rng.randint(1, max_digits))
+        digits_bottom = min(digits_top, rng.randint(1, max_digits))
 
-        top_number = random.randint(10 ** (digits_top - 1), 10**digits_top - 1)
-        bottom_number = random.randint(10 ** (digits_bottom - 1), 10**digits_bottom - 1)
+        top_number = rng.randint(10 ** (digits_top - 1), 10**digits_top - 1)
+        bottom_number = rng.randint(10 ** (digits_bottom - 1), 10**digits_bottom - 1)
 
         if bottom_number > top_number:
             top_number, bottom_number = bottom_number, top_number
 
-        problems.append((str(top_number), str(bottom_number)))
-    return problems
+        yield (str(top_number), str(bottom_number))
+
+
+def make_number_pairs(num=100, max_digits=3, rng=random):
+    """
+    Generates a list of tuples of integer pairs. Right number is bigger
+    Returns a list of strings for easier digit wise operations
+    """
+    return list(iter_number_pairs(num, max_digits, rng))
 
 
-def make_add_prompt(problem):
+def make_add_prompt(problem, verbosity="full"):
     """
     Converts a pair of strings into a parsed addition solution
+    verbosity picks the wording of the trace, see TEMPLATES
     """
+    text = TEMPLATES[verbosity]
     top, bot = problem
     gt = int(top) + int(bot)
 
-    prompt = f"Add {top} and {bot} step by step:\n"
-    top = top[::-1]
-    bot = bot[::-1]
+    prompt = text["add_header"].format(top=top, bot=bot)
+    columns, final, carry = add_columns(to_digits(top), to_digits(bot))
+    places = place_names(len(columns))
+    n_bot = len(bot)
+    add_step = text["add_step"].format
+    add_step_past = text["add_step_past"].format
+
     steps = []
-    carry = 0
-    new_carry = 0
-    final = []
-    for i in range(len(top)):
-        top_digit = int(top[i])
-        bot_digit = int(bot[i]) if i < len(bot) else 0
+    for i, (top_digit, bot_digit, carry_in, column_sum, new_carry) in enumerate(columns):
+        explanation = (add_step_past if i >= n_bot else add_step)(
+            place=places[i],
+            top_digit=top_digit,
+            bot_digit=bot_digit,
+            carry=carry_in,
+            column_sum=column_sum,
+            remainder=column_sum % 10,
+            new_carry=new_carry,
+        )
+        steps.append(explanation)
+
+    if carry != 0:
+        final.append(carry)
+
+    sol = from_digits(final)
+
+    if int(sol) != gt:
+        return False
+
+    prompt += "\n".join(steps) + text["answer"].format(sol=sol)
+
+    return f"{top} + {bot}", prompt, sol
+    # return {"question": f"{top[::-1]} + {bot[::-1]}", "answer": prompt}
+
+
+def order_pair(left, right):
+    """
+    Returns two digit strings as (larger, smaller) with leading zeros dropped, without converting to int
+    """
+    left = left.lstrip("0") or "0"
+    right = right.lstrip("0") or "0"
+    if (len(left), left) >= (len(right), right):
+        return left, right
+    return right, left
 
-        column_sum = top_digit + bot_digit + carry
-        remainder = column_sum % 10
-        new_carry = column_sum // 10
 
-        place = BASES[i]
+def sum_sequential(intermediates, steps, verbosity="full"):
+    """
+    Adds the partial products one after the other into a running total, appending an
+    addition trace per step. Returns the total.
+    """
+    text = TEMPLATES[verbosity]
+    total = intermediates[0]
+    for k in range(1, len(intermediates)):
+        _, a, total = make_add_prompt(order_pair(total, intermediates[k]), verbosity)
+        steps.append(a)
+        steps.append("")  # joins with newline
 
-        if i >= len(bot):
-            explanation = f"Adding the {place}: {top_digit} + {bot_digit} + {carry} = {column_sum} (There are no digits in the smaller number greater greater than the {place}, so we write down the {remainder} from the {place} spot from the top number)"
+        remaining = [total] + intermediates[k + 1 :]
+        if len(remaining) > 1:
+            steps.append(text["sum_next"].format(terms=" + ".join(remaining)))
         else:
-            explanation = f"Adding the {place}: {top_digit} + {bot_digit} + {carry} = {column_sum} (carry {new_carry} to the next pair, and we write down {remainder} at the {place} place)"
+            steps.append(text["sum_done"].format(total=total))
+    return total
 
-        steps.append(explanation)
-        final.insert(0, str(remainder))
 
-        carry = new_carry
+def sum_tree(intermediates, steps, verbosity="full"):
+    """
+    Adds the partial products in pairs, level by level, like a balanced binary tree.
+    Needs about log2(k) rounds for k partial products. Returns the total.
+    """
+    text = TEMPLATES[verbosity]
+    level = intermediates
+    while len(level) > 1:
+        next_level = []
+        for k in range(0, len(level) - 1, 2):
+            _, a, sol = make_add_prompt(order_pair(level[k], level[k + 1]), verbosity)
+            steps.append(a)
+            steps.append("")  # joins with newline
+            next_level.append(sol)
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+
+        if len(level) > 1:
+            steps.append(text["sum_next_pairs"].format(terms=" + ".join(level)))
+        else:
+            steps.append(text["sum_done"].format(total=level[0]))
+    return level[0]
 
-    if new_carry != 0:
-        final.insert(0, str(new_carry))
 
-    sol = "".join([e for e in final])
+def sum_columns(intermediates, steps, verbosity="full"):
+    """
+    Adds all partial products in one column addition, writing one line per column with
+    every digit in that column and a carry that may be more than one digit. Returns the total.
+    """
+    text = TEMPLATES[verbosity]
+    sum_column = text["sum_column"].format
+    joiner = text["column_joiner"]
+    rows = [to_digits(intermediate) for intermediate in intermediates]
+    width = max(len(row) for row in rows)
+    places = place_names(width)
 
-    if int(sol) != gt:
-        return False
+    final = []
+    carry = 0
+    for i in range(width):
+        column = [row[i] for row in rows if i < len(row)]
+        column_sum = sum(column) + carry
+        remainder = column_sum % 10
+        new_carry = column_sum // 10
+        steps.append(
+            sum_column(
+                place=places[i],
+                terms=joiner.join(map(str, column)),
+                carry=carry,
+                column_sum=column_sum,
+                remainder=remainder,
+                new_carry=new_carry,
+            )
+        )
+        final.append(remainder)
+        carry = new_carry
 
-    prompt += "\n".join(steps) + "\nThe answer is " + "".join([e for e in final])
+    if carry != 0:
+        final.extend(to_digits(str(carry)))
 
-    return f"{top[::-1]} + {bot[::-1]}", prompt, sol
-    # return {"question": f"{top[::-1]} + {bot[::-1]}", "answer": prompt}
+    total = from_digits(final).lstrip("0") or "0"
+    steps.append(text["sum_done"].format(total=total))
+    return total
+
+
+MULT_SUMMATIONS = {
+    "sequential": sum_sequential,
+    "tree": sum_tree,
+    "columns": sum_columns,
+}
 
 
-def make_mult_prompt(problem):
+def make_mult_prompt(problem, summation="sequential", verbosity="full"):
     """
     Make multiplication prompt step by step
+    summation picks how the partial products are added up, see MULT_SUMMATIONS:
+    "sequential" adds them one after the other, "tree" adds them in pairs level by level
+    and "columns" adds all of them at once in a single column addition
+    verbosity picks the wording of the trace, see TEMPLATES
     """
+    if summation not in MULT_SUMMATIONS:
+        raise ValueError(f"Unknown summation {summation!r}, expected one of {list(MULT_SUMMATIONS)}")
+    text = TEMPLATES[verbosity]
     top, bot = problem
     gt = int(top) * int(bot)
 
-    prompt = f"Multiply {top} and {bot} step by step:\n"
-    top = top[::-1]
-    bot = bot[::-1]
-    carry = 0
-    new_carry = 0
+    prompt = text["mult_header"].format(top=top, bot=bot)
+    top_digits = to_digits(top)
+    bot_digits = to_digits(bot)
+    places = place_names(len(bot_digits))
+    row_step = text["row_step"].format
     steps = []
-    final = []
-    total_steps = []
     intermediates = []
 
-    for i in range(len(bot)):
-        bot_digit = int(bot[i])
-        carry = 0
-        step_result = []
-
-        place = BASES[i]
+    for i, bot_digit in enumerate(bot_digits):
+        place = places[i]
 
-        explanation = f"Multiplying {top[::-1]} by the {bot_digit} in the {place} place"
+        explanation = text["row_start"].format(top=top, bot_digit=bot_digit, place=place)
         steps.append(explanation)
 
-        intermediate = []
-        for j in range(len(top)):
-            top_digit = int(top[j])
-            mult = top_digit * bot_digit + carry
-            remainder = mult % 10
-            new_carry = mult // 10
-            step_result.append(
-                f"{top_digit} * {bot_digit} + {carry} = {mult} (carry {new_carry}, remainder {remainder})"
+        columns, row, carry = multiply_row(top_digits, bot_digit)
+        step_result = [
+            row_step(
+                top_digit=top_digit,
+                bot_digit=bot_digit,
+                carry=carry_in,
+                mult=mult,
+                new_carry=new_carry,
+                remainder=mult % 10,
             )
-            carry = new_carry
-            intermediate.insert(0, str(remainder))
+            for top_digit, carry_in, mult, new_carry in columns
+        ]
 
-        if new_carry != 0:
-            intermediate.insert(0, str(new_carry))
+        if carry != 0:
+            row.append(carry)
 
-        if i > 0:
-            intermediate.append("0" * i)
-
-        intermediate = "".join([e for e in intermediate])
+        intermediate = from_digits(row) + "0" * i
 
         intermediates.append(intermediate)
 
         steps.append("\n".join(step_result))
-        explanation = f"Multiplying {top[::-1]} by the {bot_digit} in the {place} place yields {intermediate}\n"
+        explanation = text["row_end"].format(
+            top=top, bot_digit=bot_digit, place=place, intermediate=intermediate
+        )
         steps.append(explanation)
 
     # solving for the ints
-    explanation = f"Adding all of our intermediate solutions together {' + '.join(intermediates)}:\n"
+    explanation = text["sum_start"].format(terms=" + ".join(intermediates))
     steps.append(explanation)
 
-    while len(intermediates) > 1:
-        left, right = intermediates.pop(0), intermediates.pop(0)
-
-        _, a, sol = make_add_prompt(
-            (str(max(int(left), int(right))), str(min(int(left), int(right))))
-        )
-        steps.append(a)
-        steps.append("")  # joins with newline
-        intermediates.insert(0, sol)
-
-        if len(intermediates) > 1:
-            steps.append(
-                f"After adding the intermediates now are {' + '.join(intermediates)}"
-            )
-        else:
-            steps.append(
-                f"Adding all of the intermediates results in the final solution of: {' + '.join(intermediates)}"
-            )
-
-    sol = "".join([e for e in intermediates[0]])
+    sol = MULT_SUMMATIONS[summation](intermediates, steps, verbosity)
     if int(sol) != gt:
         return False
 
     prompt += "\n".join(steps)
-    return f"{top[::-1]} * {bot[::-1]}", prompt, sol
+    return f"{top} * {bot}", prompt, sol
 
 
 # TODO touble shoot multiplication steps
-def make_subtract_prompt(problem):
+def make_subtract_prompt(problem, verbosity="full"):
     """
     Converts a pair of strings into a parsed subtraction solution, step by step.
+    verbosity picks the wording of the trace, see TEMPLATES
     """
+    text = TEMPLATES[verbosity]
     top, bot = problem
     gt = int(top) - int(bot)
 
-    prompt = f"Subtract {bot} from {top} step by step:\n"
-    top = top[::-1]
-    bot = bot[::-1]
-    steps = []
-    borrow = 0
-    final = []
-    for i in range(len(top)):
-        top_digit = int(top[i])
-        bot_digit = int(bot[i]) if i < len(bot) else 0
-
-        column_sub = top_digit - bot_digit - borrow
-        if column_sub < 0:
-            column_sub += 10
-            borrow = 1
-        else:
-            borrow = 0
+    prompt = text["sub_header"].format(top=top, bot=bot)
+    columns, final = subtract_columns(to_digits(top), to_digits(bot))
+    places = place_names(len(columns))
+    sub_step = text["sub_step"].format
 
-        place = BASES[i]
-
-        explanation = f"Subtracting the {place}: {top_digit} - {bot_digit} - previous borrow {borrow} = {column_sub} (place the {column_sub} at the {place} place)"
+    steps = []
+    borrow_in = 0
+    for i, (top_digit, bot_digit, borrow, column_sub) in enumerate(columns):
+        explanation = sub_step(
+            place=places[i],
+            top_digit=top_digit,
+            borrowed_top=top_digit + 10 * borrow,
+            bot_digit=bot_digit,
+            borrow_in=borrow_in,
+            borrow=borrow,
+            column_sub=column_sub,
+        )
         steps.append(explanation)
-        final.insert(0, str(column_sub))
+        borrow_in = borrow
 
-    sol = "".join(final)
+    sol = from_digits(final)
 
     if int(sol) != gt:
         return False
 
-    prompt += "\n".join(steps) + "\nThe answer is " + sol
+    prompt += "\n".join(steps) + text["answer"].format(sol=sol)
 
-    return f"{top[::-1]} - {bot[::-1]}", prompt, sol
+    return f"{top} - {bot}", prompt, sol
 
 
-def make_divide_prompt(problem):
+def make_divide_prompt(problem, verbosity="full"):
     """
     Converts a pair of strings into a parsed division solution, explaining each step in the style of long division.
-    This does with remainder, so there is only the need for one subtraction.
-    long division doesn't work yet but this should be fine tbh.
-    TODO implement long division
+    One step is written per digit of the dividend: bring the digit down next to the running remainder,
+    find how many times the divisor fits, multiply back and subtract. The trace grows with the number
+    of digits, not with the size of the quotient.
+    verbosity picks the wording of the trace, see TEMPLATES
     """
+    text = TEMPLATES[verbosity]
     top, bot = problem
     divisor = int(bot)
     dividend = int(top)
     if divisor == 0:
         return f"{top} / {bot}", "Cannot divide by zero", "undefined"
 
-    quotient = 0
-    remainder = dividend
-
-    prompt = f"How many times does {bot} fit into {top}. Divide {top} by {bot} step by step:\n"
+    prompt = text["div_header"].format(top=top, bot=bot)
+    div_first = text["div_first"].format
+    div_step = text["div_step"].format
     steps = []
+    quotient_digits = []
+    remainder = 0
 
-    # Trying to find the highest multiplier
-    multiplier = 0
-    product = 0
-    while product <= dividend:
+    for i, digit in enumerate(top):
+        current = remainder * 10 + int(digit)
+        quotient_digit = current // divisor
+        product = divisor * quotient_digit
+        new_remainder = current - product
 
-        if product == dividend:
-            steps.append(
-                f"Trying {divisor} * {multiplier} = {product} (which is exactly {dividend})"
-            )
-            break
-        else:
-            steps.append(
-                f"Trying {divisor} * {multiplier} = {product} (which is {'not ' if product <= dividend else ''}less than or equal to {dividend})"
-            )
-            multiplier += 1
-        product = divisor * multiplier
-
-    # Perform the subtraction
-    if product > dividend:
-        multiplier -= 1
-        product = divisor * multiplier
-        remainder = dividend - product
-
-        _, a, sol = make_subtract_prompt(
-            (
-                str(max(int(dividend), int(product))),
-                str(min(int(dividend), int(product))),
+        steps.append(
+            (div_first if i == 0 else div_step)(
+                digit=digit,
+                remainder=remainder,
+                current=current,
+                divisor=divisor,
+                quotient_digit=quotient_digit,
+                product=product,
+                new_remainder=new_remainder,
             )
         )
+        quotient_digits.append(str(quotient_digit))
+        remainder = new_remainder
 
-        steps.append(
-            f"{divisor} * {multiplier} = {product} which is less than {dividend}"
+    quotient = "".join(quotient_digits).lstrip("0") or "0"
+
+    if int(quotient) != dividend // divisor or remainder != dividend % divisor:
+        return False
+
+    prompt += "\n".join(steps) + text["div_answer"].format(quotient=quotient, remainder=remainder)
+
+    return f"{top} / {bot}", prompt, f"{quotient}R{remainder}"
+
+
+# Bump when generated data changes in a way that the probe problems in generate.op_fingerprint
+# cannot see, e.g. a change to how pairs are sampled. Cached shards are then regenerated.
+GENERATOR_VERSION = 1
+
+OPERATIONS = {
+    "+": make_add_prompt,
+    "-": make_subtract_prompt,
+    "*": make_mult_prompt,
+    "/": make_divide_prompt,
+}
+
+# (operation, number of problems, max digits) in the order they are generated
+DEFAULT_MIX = [
+    ("+", 2000, 5),
+    ("-", 2000, 5),
+    ("*", 1000, 3),
+    ("/", 1000, 3),
+]
+
+
+# Every digit, word and punctuation mark is one token, close to how LLaMA splits traces
+TOKEN_PATTERN = re.compile(r"\d|[^\W\d]+|[^\w\s]")
+
+
+def count_tokens(text, tokenizer=None):
+    """
+    Counts the tokens in text with a Hugging Face tokenizer (anything with an encode method)
+    or any callable returning a list of tokens. Without one, TOKEN_PATTERN gives an estimate.
+    """
+    if tokenizer is None:
+        return len(TOKEN_PATTERN.findall(text))
+    if hasattr(tokenizer, "encode"):
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    return len(tokenizer(text))
+
+
+def verbosity_report(num=200, max_digits=5, tokenizer=None, seed=0):
+    """
+    Returns the average answer length in tokens for every verbosity level and operation,
+    as {verbosity: {op: average}}. Every level is measured on the same problems.
+    """
+    pairs = make_number_pairs(num, max_digits, random.Random(seed))
+    report = {}
+    for verbosity in VERBOSITY:
+        report[verbosity] = {}
+        for op, make_prompt in OPERATIONS.items():
+            total = sum(count_tokens(make_prompt(pair, verbosity=verbosity)[1], tokenizer) for pair in pairs)
+            report[verbosity][op] = total / num
+    return report
+
+
+def iter_problem_examples(
+    op, num, max_digits, start_id=1, rng=random, sampler=iter_number_pairs, options=None
+):
+    """
+    Yields num step by step examples for a single operation, numbered from start_id
+    sampler is called as sampler(num, max_digits, rng) and must yield (top, bottom) string pairs
+    options are passed to the prompt builder as keyword arguments, e.g. {"summation": "columns"} for "*"
+    """
+    make_prompt = OPERATIONS[op]
+    options = options or {}
+    for i, pair in enumerate(sampler(num, max_digits, rng)):
+        q, a, s = make_prompt(pair, **options)
+        yield {"question": q, "answer": a, "question_id": start_id + i}
+
+
+def iter_examples(mix=DEFAULT_MIX, up_to=15, options=None, rng=random, sampler=iter_number_pairs):
+    """
+    Yields the full dataset one example at a time: the basic arithmetic table first,
+    then the step by step problems in mix. Nothing is kept in memory, so this can be
+    streamed straight into a ShardWriter.
+    options maps an operation to the keyword arguments for its prompt builder
+    rng and sampler are passed on to iter_problem_examples
+    """
+    options = options or {}
+    question_count = 0
+    for example in iter_basic_arithmetic(up_to):
+        question_count = example["question_id"]
+        yield example
+
+    for op, num, max_digits in mix:
+        yield from iter_problem_examples(
+            op,
+            num,
+            max_digits,
+            start_id=question_count + 1,
+            rng=rng,
+            sampler=sampler,
+            options=options.get(op),
         )
-        steps.append(
-            f"Now subtract {product} from {dividend} to get the remainder: {a}"
-            # {dividend} - {product} = {remainder}
+        question_count += num
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    from shards import ShardWriter
+
+    parser = argparse.ArgumentParser(description="Generate the mathnet dataset as JSONL shards")
+    parser.add_argument("--out", default="mathnet_shards", help="output directory")
+    parser.add_argument("--prefix", default="basic_arithmetic", help="shard file name prefix")
+    parser.add_argument("--shard-mb", type=float, default=64, help="uncompressed size cap per shard")
+    parser.add_argument("--compression", choices=["gzip", "zstd"], default=None)
+    parser.add_argument("--up-to", type=int, default=15, help="size of the basic arithmetic table")
+    parser.add_argument("--add", type=int, default=2000, help="number of addition problems")
+    parser.add_argument("--sub", type=int, default=2000, help="number of subtraction problems")
+    parser.add_argument("--mult", type=int, default=1000, help="number of multiplication problems")
+    parser.add_argument("--div", type=int, default=1000, help="number of division problems")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="generate with this many processes, with per shard seeds (0 for every core)",
+    )
+    parser.add_argument(
+        "--verbosity",
+        choices=VERBOSITY,
+        default="full",
+        help="wording of the step by step traces",
+    )
+    parser.add_argument(
+        "--report-verbosity",
+        action="store_true",
+        help="print the average tokens per trace for every verbosity level and exit",
+    )
+    parser.add_argument(
+        "--mult-summation",
+        choices=list(MULT_SUMMATIONS),
+        default="sequential",
+        help="how multiplication traces add up their partial products",
+    )
+    parser.add_argument(
+        "--sampler",
+        choices=["random", "numpy"],
+        default="random",
+        help="number pair sampler: iter_number_pairs, or the vectorized NumPy sampler",
+    )
+    parser.add_argument(
+        "--shard-examples",
+        type=int,
+        default=100_000,
+        help="examples per shard when generating with --workers",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="with --workers, regenerate every shard instead of reusing finished ones in --out",
+    )
+    parser.add_argument(
+        "--dedup-mb",
+        type=float,
+        default=None,
+        help="drop repeated problems using a Bloom filter of this size; with --workers the "
+        "shards are generated into --out/raw and deduplicated into --out",
+    )
+    parser.add_argument(
+        "--heldout",
+        action="append",
+        default=[],
+        help="shard directory of held-out problems to keep out of the output (repeatable)",
+    )
+    args = parser.parse_args()
+
+    if args.report_verbosity:
+        for op, _, max_digits in DEFAULT_MIX:
+            report = verbosity_report(max_digits=max_digits, seed=args.seed or 0)
+            averages = ", ".join(f"{verbosity} {report[verbosity][op]:.1f}" for verbosity in VERBOSITY)
+            print(f"{op} ({max_digits} digits) average tokens: {averages}")
+        raise SystemExit
+
+    counts = {"+": args.add, "-": args.sub, "*": args.mult, "/": args.div}
+    mix = [(op, counts[op], max_digits) for op, _, max_digits in DEFAULT_MIX]
+    options = {op: {"verbosity": args.verbosity} for op in OPERATIONS}
+    options["*"]["summation"] = args.mult_summation
+
+    deduplicator = None
+    if args.dedup_mb is not None or args.heldout:
+        from dedup import Deduplicator
+        from shards import iter_shards
+
+        heldout = (example for path in args.heldout for example in iter_shards(path))
+        deduplicator = Deduplicator(
+            max_bytes=int((args.dedup_mb or 64) * 2**20),
+            expected_items=len(BASIC_OPERANDS) * args.up_to**2 + sum(counts.values()),
+            heldout=heldout,
         )
-    else:
-        remainder = dividend - product
-        steps.append(
-            f"{divisor} * {multiplier} = {product} which is exactly {dividend}, hence remainder is 0"
+
+    if args.workers is not None:
+        from generate import generate_parallel
+
+        # raw shards stay in their own directory so reruns can resume them
+        raw_dir = os.path.join(args.out, "raw") if deduplicator is not None else args.out
+        manifest = generate_parallel(
+            raw_dir,
+            mix,
+            up_to=args.up_to,
+            seed=args.seed or 0,
+            shard_examples=args.shard_examples,
+            workers=args.workers or None,
+            prefix=args.prefix,
+            compression=args.compression,
+            sampler=args.sampler,
+            options=options,
+            resume=not args.no_resume,
         )
+        print(f"Wrote {manifest['num_examples']} examples to {len(manifest['shards'])} shards in {raw_dir}")
+        if deduplicator is not None:
+            from dedup import dedup_shards
+
+            writer = dedup_shards(
+                raw_dir,
+                args.out,
+                deduplicator,
+                prefix=args.prefix,
+                max_bytes=int(args.shard_mb * 2**20),
+                compression=args.compression,
+            )
+            print(f"Wrote {writer.num_examples} examples to {len(writer.shards)} shards in {args.out}")
+            print(f"Dedup: {deduplicator.report()}")
+        raise SystemExit
 
-    prompt += (
-        "\n".join(steps)
-        + f"\nThus, the quotient is {multiplier} and the remainder is {remainder}\nThe answer is {multiplier}R{remainder}"
-    )
+    if args.seed is not None:
+        random.seed(args.seed)
 
-    return f"{top} / {bot}", prompt, f"{multiplier}R{remainder}"
+    rng, sampler = random, iter_number_pairs
+    if args.sampler == "numpy":
+        import numpy as np
 
+        from batched import iter_sampled_pairs
 
-# Example of how to integrate these functions into your main script
+        rng, sampler = np.random.default_rng(args.seed), iter_sampled_pairs
 
-if __name__ == "__main__":
-    # print(make_subtract_prompt(("983", "612")))
-    # print(make_divide_prompt(("983", "612")))
-
-    examples = basic_arithmetic()
-    question_count = len(
-        examples
-    )  # Starts counting from the number of basic arithmetic questions
-
-    # Adding addition problems with index
-    for pair in make_number_pairs(num=2000, max_digits=5):
-        q, a, s = make_add_prompt(pair)
-        question_count += 1
-        examples.append({"question": q, "answer": a, "question_id": question_count})
-
-    # Adding subtraction problems with indexed IDs
-    for pair in make_number_pairs(num=2000, max_digits=5):
-        q, a, s = make_subtract_prompt(pair)
-        question_count += 1
-        examples.append({"question": q, "answer": a, "question_id": question_count})
-
-    # Adding multiplication problems with indexed IDs
-    for pair in make_number_pairs(num=1000, max_digits=3):
-        q, a, s = make_mult_prompt(pair)
-        question_count += 1
-        examples.append({"question": q, "answer": a, "question_id": question_count})
-
-    # Adding division problems with indexed IDs
-    for pair in make_number_pairs(num=1000, max_digits=3):
-        q, a, s = make_divide_prompt(pair)
-        question_count += 1
-        examples.append({"question": q, "answer": a, "question_id": question_count})
-
-    with open("basic_arithmetic.json", "w", encoding="utf-8") as file:
-        json.dump(examples, file, indent=4)
-    # problem = ("1234589", "9876541")
-    # prompt = make_add_prompt(problem)
-    # print(prompt["answer"])
-
-    # problem = ("983", "612")
+    examples = iter_examples(mix, up_to=args.up_to, options=options, rng=rng, sampler=sampler)
+    if deduplicator is not None:
+        examples = deduplicator.filter(examples)
+
+    with ShardWriter(
+        args.out,
+        prefix=args.prefix,
+        max_bytes=int(args.shard_mb * 2**20),
+        compression=args.compression,
+    ) as writer:
+        writer.write_all(examples)
+
+    print(f"Wrote {writer.num_examples} examples to {len(writer.shards)} shards in {args.out}")
+    if deduplicator is not None:
+        print(f"Dedup: {deduplicator.report()}")
@@ -0,0 +1,151 @@
+"""
+Weighted streaming interleave of several training sources.
+
+Each source is a factory that opens an iterator at a given item offset, for example
+mathnet_source() for freshly generated traces or hf_source("gsm8k", "main") for a streamed
+Hugging Face dataset. The mixture draws which source the next item comes from with a Random
+seeded by (seed, step), using weights that may change over the run, and pulls that one
+item. Nothing is copied or concatenated, the order is fully determined by the seed, and
+state_dict() holds the step and each source's offset so a run can resume exactly.
+"""
+
+import random
+from bisect import bisect_right
+from itertools import accumulate
+
+import torch
+
+from generate import derive_seed
+
+
+def piecewise_schedule(points):
+    """
+    Weights that switch at given steps. points is a list of (start_step, weights) sorted by step.
+    """
+    starts = [start for start, _ in points]
+
+    def schedule(step):
+        return points[max(0, bisect_right(starts, step) - 1)][1]
+
+    return schedule
+
+
+def linear_schedule(start_weights, end_weights, steps):
+    """
+    Weights that move linearly from start_weights to end_weights over steps, then stay
+    """
+    names = set(start_weights) | set(end_weights)
+
+    def schedule(step):
+        t = min(1.0, step / steps) if steps else 1.0
+        return {
+            name: (1 - t) * start_weights.get(name, 0.0) + t * end_weights.get(name, 0.0)
+            for name in names
+        }
+
+    return schedule
+
+
+def mathnet_source(**kwargs):
+    """
+    Source factory for MathnetStream, keyword arguments are passed to it
+    """
+    from stream import MathnetStream
+
+    def open_at(start):
+        return iter(MathnetStream(position=start, **kwargs))
+
+    return open_at
+
+
+def hf_source(path, name=None, split="train", **kwargs):
+    """
+    Source factory for a streamed Hugging Face dataset, e.g. hf_source("yahma/alpaca-cleaned")
+    """
+    from datasets import load_dataset
+
+    def open_at(start):
+        dataset = load_dataset(path, name, split=split, streaming=True, **kwargs)
+        return iter(dataset.skip(start))
+
+    return open_at
+
+
+class WeightedMixture(torch.utils.data.IterableDataset):
+    """
+    Interleaves sources by weight without materializing any of them.
+
+    sources     dict of name -> factory(start) returning an iterator from item start
+    weights     dict of name -> weight, or a function of the step returning such a dict
+                (see piecewise_schedule and linear_schedule)
+    transforms  optional dict of name -> function applied to that source's items, e.g. to
+                bring them all to one format
+    cycle       reopen a source from the start when it runs out, otherwise drop it
+
+    Iterate it in the main process (DataLoader num_workers=0); the sources can do their own
+    parallel work.
+    """
+
+    def __init__(self, sources, weights, seed=0, transforms=None, cycle=True):
+        super().__init__()
+        self.sources = sources
+        self.schedule = weights if callable(weights) else (lambda step: weights)
+        self.seed = seed
+        self.transforms = transforms or {}
+        self.cycle = cycle
+        self.load_state_dict({"step": 0, "offsets": {}, "epochs": {}, "exhausted": []})
+
+    def state_dict(self):
+        return {
+            "step": self.step,
+            "offsets": dict(self.offsets),
+            "epochs": dict(self.epochs),
+            "exhausted": sorted(self.exhausted),
+        }
+
+    def load_state_dict(self, state):
+        self.step = state["step"]
+        self.offsets = {name: state["offsets"].get(name, 0) for name in self.sources}
+        self.epochs = {name: state["epochs"].get(name, 0) for name in self.sources}
+        self.exhausted = set(state["exhausted"])
+
+    def choose(self, step):
+        """
+        Name of the source the item at step is drawn from
+        """
+        weights = self.schedule(step)
+        names = sorted(name for name, weight in weights.items() if weight > 0 and name not in self.exhausted)
+        if not names:
+            return None
+        cumulative = list(accumulate(weights[name] for name in names))
+        rng = random.Random(derive_seed(self.seed, "mixture", step))
+        return names[bisect_right(cumulative, rng.random() * cumulative[-1])]
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None and worker_info.num_workers > 1:
+            raise ValueError("WeightedMixture must be iterated by a single process, use num_workers=0")
+
+        iterators = {}
+        while True:
+            name = self.choose(self.step)
+            if name is None:
+                return
+            if name not in iterators:
+                iterators[name] = self.sources[name](self.offsets[name])
+
+            try:
+                item = next(iterators[name])
+            except StopIteration:
+                del iterators[name]
+                if self.cycle and self.offsets[name] > 0:
+                    self.offsets[name] = 0
+                    self.epochs[name] += 1
+                else:
+                    self.exhausted.add(name)
+                continue
+
+            self.offsets[name] += 1
+            self.step += 1
+            transform = self.transforms.get(name)
+            yield item if transform is None else transform(item)
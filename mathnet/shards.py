@@ -0,0 +1,209 @@
+"""
+Streaming JSONL shard writer and reader for mathnet datasets.
+
+Examples are written one line at a time into numbered shards that are capped in size,
+so memory use stays flat no matter how many examples are generated. Every output
+directory gets a manifest.json listing its shards.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+
+MANIFEST_NAME = "manifest.json"
+
+EXTENSIONS = {
+    None: ".jsonl",
+    "gzip": ".jsonl.gz",
+    "zstd": ".jsonl.zst",
+}
+
+
+def open_shard(path, mode, compression=None):
+    """
+    Opens a shard file for binary reading ("rb") or writing ("wb") with the given compression
+    """
+    if compression is None:
+        return open(path, mode)
+    if compression == "gzip":
+        # mtime=0 keeps the compressed bytes identical between runs
+        return gzip.GzipFile(path, mode, compresslevel=6, mtime=0)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("zstd compression needs the zstandard package: pip install zstandard") from e
+        if mode == "wb":
+            return zstandard.ZstdCompressor(level=3).stream_writer(open(path, "wb"))
+        # the decompressor's reader does not iterate over lines, the buffered wrapper does
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb")))
+    raise ValueError(f"Unknown compression {compression!r}, expected one of {list(EXTENSIONS)}")
+
+
+class ShardWriter:
+    """
+    Writes examples to numbered JSONL shards in out_dir. A new shard is started once the
+    current one would go over max_bytes of uncompressed JSON. close() flushes the last
+    shard and writes the manifest; the writer can also be used as a context manager.
+    """
+
+    def __init__(self, out_dir, prefix="mathnet", max_bytes=64 * 2**20, compression=None):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {list(EXTENSIONS)}")
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.shards = []
+        self.num_examples = 0
+
+        self._file = None
+        self._name = None
+        self._count = 0
+        self._bytes = 0
+        self._hash = None
+
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _start_shard(self):
+        self._name = f"{self.prefix}-{len(self.shards):05d}{EXTENSIONS[self.compression]}"
+        self._file = open_shard(os.path.join(self.out_dir, self._name), "wb", self.compression)
+        self._count = 0
+        self._bytes = 0
+        self._hash = hashlib.sha256()
+
+    def _finish_shard(self):
+        self._file.close()
+        self.shards.append(
+            {
+                "file": self._name,
+                "num_examples": self._count,
+                "num_bytes": self._bytes,
+                "sha256": self._hash.hexdigest(),
+            }
+        )
+        self._file = None
+
+    def write(self, example):
+        """
+        Appends one example (a JSON serialisable dict) to the current shard
+        """
+        line = (json.dumps(example, ensure_ascii=False) + "\n").encode("utf-8")
+        if self._file is not None and self._count and self._bytes + len(line) > self.max_bytes:
+            self._finish_shard()
+        if self._file is None:
+            self._start_shard()
+
+        self._file.write(line)
+        self._hash.update(line)
+        self._count += 1
+        self._bytes += len(line)
+        self.num_examples += 1
+
+    def write_all(self, examples):
+        """
+        Writes every example from an iterable, consuming it lazily
+        """
+        for example in examples:
+            self.write(example)
+        return self
+
+    def close(self):
+        """
+        Finishes the last shard and writes manifest.json, returning the manifest
+        """
+        if self._file is not None:
+            self._finish_shard()
+        return write_manifest(self.out_dir, self.shards, self.compression)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._file is not None:
+            self._file.close()
+
+
+def write_shard(out_dir, name, examples, compression=None):
+    """
+    Writes every example of an iterable into a single shard file with no size cap and
+    returns its manifest entry. Used when shard boundaries are fixed up front.
+    """
+    path = os.path.join(out_dir, name)
+    digest = hashlib.sha256()
+    count = 0
+    num_bytes = 0
+    with open_shard(path, "wb", compression) as file:
+        for example in examples:
+            line = (json.dumps(example, ensure_ascii=False) + "\n").encode("utf-8")
+            file.write(line)
+            digest.update(line)
+            count += 1
+            num_bytes += len(line)
+    return {
+        "file": name,
+        "num_examples": count,
+        "num_bytes": num_bytes,
+        "sha256": digest.hexdigest(),
+    }
+
+
+def write_manifest(out_dir, shards, compression=None, **extra):
+    """
+    Writes manifest.json for a list of shard entries and returns it. Any extra keyword
+    arguments are stored alongside the shard list.
+    """
+    manifest = {
+        "format": "jsonl",
+        "compression": compression,
+        "num_examples": sum(shard["num_examples"] for shard in shards),
+        "num_bytes": sum(shard["num_bytes"] for shard in shards),
+        **extra,
+        "shards": shards,
+    }
+    with open(os.path.join(out_dir, MANIFEST_NAME), "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=4)
+    return manifest
+
+
+def read_manifest(out_dir):
+    """
+    Loads the manifest.json of a shard directory
+    """
+    with open(os.path.join(out_dir, MANIFEST_NAME), encoding="utf-8") as file:
+        return json.load(file)
+
+
+def iter_shards(out_dir):
+    """
+    Yields every example of a shard directory in order, one shard open at a time
+    """
+    manifest = read_manifest(out_dir)
+    for shard in manifest["shards"]:
+        with open_shard(os.path.join(out_dir, shard["file"]), "rb", manifest["compression"]) as file:
+            for line in file:
+                yield json.loads(line)
+
+
+if __name__ == "__main__":
+    # Round trip every compression through ShardWriter and iter_shards
+    examples = [{"question": f"{i} + {i}", "answer": str(2 * i)} for i in range(1000)]
+    for compression in EXTENSIONS:
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                print("zstd: skipped, zstandard is not installed")
+                continue
+        with tempfile.TemporaryDirectory() as out_dir:
+            with ShardWriter(out_dir, max_bytes=8192, compression=compression) as writer:
+                for example in examples:
+                    writer.write(example)
+            assert list(iter_shards(out_dir)) == examples, compression
+            print(f"{compression}: {len(writer.shards)} shards round trip")
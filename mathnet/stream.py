@@ -0,0 +1,103 @@
+"""
+Infinite streaming dataset that runs the mathnet trace builders inside DataLoader workers.
+
+Every example is a pure function of (seed, global index): its operation is drawn from the
+mixing weights and its pair from iter_number_pairs, both with a Random seeded by
+derive_seed(seed, "stream", index). Ranks interleave by example (rank r gets global indices
+r, r + world_size, ...) and within a rank, workers take whole batches in turn, matching the
+order in which a DataLoader collects them. A rank therefore sees the same sequence for any
+number of workers, and restarting with position set to the number of examples the rank has
+already consumed continues exactly where it stopped.
+"""
+
+import os
+import random
+from bisect import bisect_right
+from itertools import accumulate
+
+import torch
+
+from generate import derive_seed
+from mathnet_dset import OPERATIONS, iter_number_pairs
+
+
+DEFAULT_WEIGHTS = {"+": 1.0, "-": 1.0, "*": 1.0, "/": 1.0}
+
+DEFAULT_MAX_DIGITS = {"+": 5, "-": 5, "*": 3, "/": 3}
+
+
+def _dist_info():
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+
+
+class MathnetStream(torch.utils.data.IterableDataset):
+    """
+    Endless stream of freshly generated step by step problems.
+
+    weights      relative frequency of each operation
+    max_digits   max operand digits per operation
+    options      keyword arguments for each operation's prompt builder
+    batch_size   the DataLoader batch size, workers take whole batches in turn
+    position     examples this rank has already consumed, to resume a run
+    transform    optional function applied to every example dict in the worker,
+                 e.g. to format and tokenize it
+    rank and world_size default to torch.distributed, then the RANK and WORLD_SIZE variables.
+    """
+
+    def __init__(
+        self,
+        weights=DEFAULT_WEIGHTS,
+        max_digits=DEFAULT_MAX_DIGITS,
+        seed=0,
+        options=None,
+        batch_size=1,
+        position=0,
+        transform=None,
+        rank=None,
+        world_size=None,
+    ):
+        super().__init__()
+        if position % batch_size:
+            raise ValueError(f"position {position} must be a multiple of batch_size {batch_size}")
+        self.ops = [op for op, weight in weights.items() if weight > 0]
+        self.cumulative = list(accumulate(weights[op] for op in self.ops))
+        self.max_digits = max_digits
+        self.seed = seed
+        self.options = options or {}
+        self.batch_size = batch_size
+        self.position = position
+        self.transform = transform
+
+        dist_rank, dist_world_size = _dist_info()
+        self.rank = dist_rank if rank is None else rank
+        self.world_size = dist_world_size if world_size is None else world_size
+
+    def example(self, index):
+        """
+        Builds the example at global stream index
+        """
+        rng = random.Random(derive_seed(self.seed, "stream", index))
+        op = self.ops[bisect_right(self.cumulative, rng.random() * self.cumulative[-1])]
+        pair = next(iter_number_pairs(1, self.max_digits[op], rng))
+        q, a, s = OPERATIONS[op](pair, **self.options.get(op, {}))
+        return {"question": q, "answer": a, "solution": s, "op": op, "index": index}
+
+    def _local_indices(self, worker_id, num_workers):
+        """
+        Rank local indices this worker produces, starting from position
+        """
+        batch = worker_id
+        while True:
+            start = self.position + batch * self.batch_size
+            yield from range(start, start + self.batch_size)
+            batch += num_workers
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        for local in self._local_indices(worker_id, num_workers):
+            example = self.example(local * self.world_size + self.rank)
+            yield example if self.transform is None else self.transform(example)
@@ -0,0 +1,149 @@
+"""
+Lazy, random access view over the mathnet generators.
+
+A VirtualDataset never stores examples. Example i is rebuilt on demand from its position:
+the basic arithmetic table is indexed directly and every step by step problem draws its pair
+from a Random seeded with derive_seed(seed, "virtual", entry, op, max_digits, index), where
+entry is the position of its block in mix. len(), indexing, slicing and shuffled views all
+take O(1) memory, so a trainer can sample from billions of problems without anything on disk.
+"""
+
+import random
+from bisect import bisect_right
+
+from generate import derive_seed
+from mathnet_dset import (
+    BASIC_OPERANDS,
+    DEFAULT_MIX,
+    OPERATIONS,
+    basic_arithmetic_example,
+    iter_number_pairs,
+)
+
+
+MASK64 = 2**64 - 1
+
+
+def _mix64(x):
+    """
+    splitmix64 finalizer, a cheap well spread 64 bit hash
+    """
+    x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & MASK64
+    x = (x ^ (x >> 27)) * 0x94D049BB133111EB & MASK64
+    return x ^ (x >> 31)
+
+
+class ShuffledIndices:
+    """
+    A pseudo random permutation of range(n) computed one position at a time with a
+    four round Feistel network and cycle walking. Uses O(1) memory for any n.
+    """
+
+    ROUNDS = 4
+
+    def __init__(self, n, seed=0):
+        self.n = n
+        bits = max(2, (n - 1).bit_length())
+        self.half_bits = (bits + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.keys = [derive_seed(seed, "feistel", r) for r in range(self.ROUNDS)]
+
+    def _encrypt(self, x):
+        left, right = x >> self.half_bits, x & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix64(right ^ key) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, k):
+        if not 0 <= k < self.n:
+            raise IndexError(k)
+        # the domain is less than 4n, so this walks a couple of steps on average
+        x = self._encrypt(k)
+        while x >= self.n:
+            x = self._encrypt(x)
+        return x
+
+
+class _MappedIndices:
+    """
+    Position k maps to outer[inner[k]], used to stack slices and shuffles on top of each other
+    """
+
+    def __init__(self, outer, inner):
+        self.outer = outer
+        self.inner = inner
+
+    def __len__(self):
+        return len(self.inner)
+
+    def __getitem__(self, k):
+        return self.outer[self.inner[k]]
+
+
+class VirtualDataset:
+    """
+    An indexable dataset of mathnet examples that computes example i on demand.
+    The layout matches iter_examples: the basic arithmetic table (if up_to > 0) followed by
+    one block per (op, num, max_digits) entry of mix. num may be as large as you like.
+    options maps an operation to the keyword arguments for its prompt builder.
+    """
+
+    def __init__(self, mix=DEFAULT_MIX, up_to=15, seed=0, options=None, indices=None):
+        self.mix = list(mix)
+        self.up_to = up_to
+        self.seed = seed
+        self.options = options or {}
+
+        # first index of every block, the basic table counts as the first block
+        self._blocks = [("basic", len(BASIC_OPERANDS) * up_to**2, None)] + self.mix
+        self._starts = []
+        total = 0
+        for _, num, _ in self._blocks:
+            self._starts.append(total)
+            total += num
+        self.total = total
+        self.indices = range(total) if indices is None else indices
+
+    def _view(self, indices):
+        return VirtualDataset(self.mix, self.up_to, self.seed, self.options, indices)
+
+    def example(self, index):
+        """
+        Builds the example at absolute position index of the full layout
+        """
+        block = bisect_right(self._starts, index) - 1
+        op, _, max_digits = self._blocks[block]
+        local = index - self._starts[block]
+        if op == "basic":
+            return basic_arithmetic_example(local, self.up_to)
+
+        # block 0 is the basic table, so block - 1 is the entry of mix
+        rng = random.Random(derive_seed(self.seed, "virtual", block - 1, op, max_digits, local))
+        pair = next(iter_number_pairs(1, max_digits, rng))
+        q, a, s = OPERATIONS[op](pair, **self.options.get(op, {}))
+        return {"question": q, "answer": a, "question_id": index + 1}
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._view(_MappedIndices(self.indices, range(len(self))[key]))
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(key)
+        return self.example(self.indices[key])
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.example(self.indices[k])
+
+    def shuffled(self, seed=0):
+        """
+        Returns a view of this dataset in a pseudo random order, without materializing it
+        """
+        return self._view(_MappedIndices(self.indices, ShuffledIndices(len(self), seed)))
@@ -0,0 +1,166 @@
+"""
+Training throughput instrumentation.
+
+ThroughputCallback writes one JSON line per optimizer step with tokens per second, the
+share of tokens that are not padding, how the step's time splits between waiting for the
+next batches and computing, and peak host (RSS) and accelerator memory. It works on CPU
+only runs and needs nothing but the Trainer.
+
+    trainer = SFTTrainer(..., callbacks=[ThroughputCallback("outputs/throughput.jsonl")])
+"""
+
+import json
+import os
+import sys
+import time
+
+import torch
+from transformers import TrainerCallback
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far, in MiB, or None where unsupported
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def accelerator_memory_mb():
+    """
+    Peak allocated CUDA memory since the last reset, or current MPS memory, in MiB. None on CPU.
+    """
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2**20
+    if hasattr(torch, "mps") and torch.backends.mps.is_available():
+        return torch.mps.driver_allocated_memory() / 2**20
+    return None
+
+
+def _synchronize():
+    # kernels run asynchronously, so wait for them before reading the clock
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+class ThroughputCallback(TrainerCallback):
+    """
+    Records per optimizer step:
+        tokens, non_padding_tokens, non_padding_ratio, samples
+        tokens_per_s, non_padding_tokens_per_s, samples_per_s
+        step_s, data_wait_s (fetching and collating the step's batches), compute_s
+        (forward, backward and optimizer step), data_wait_fraction
+        peak_rss_mb, accelerator_mb
+    and appends them to path as JSON lines, every every steps. Tokens are counted from the
+    inputs the model sees, with a forward pre-hook. Non-padding tokens are taken from a 2D
+    attention_mask, otherwise from input_ids that are not pad_token_id (taken from the
+    trainer's tokenizer if not given). Only the main process writes; the numbers are that
+    process's own.
+    """
+
+    def __init__(self, path="throughput.jsonl", every=1, pad_token_id=None):
+        self.path = path
+        self.every = every
+        self.pad_token_id = pad_token_id
+        self._hook = None
+        self._reset_counts()
+
+    def _reset_counts(self):
+        self.tokens = 0
+        self.non_padding_tokens = 0
+        self.samples = 0
+        self.data_wait = 0.0
+        self.compute = 0.0
+        self.steps = 0
+
+    def _count_inputs(self, module, args, kwargs):
+        if not module.training:
+            return
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if input_ids is None:
+            return
+        attention_mask = kwargs.get("attention_mask")
+        self.tokens += input_ids.numel()
+        self.samples += input_ids.shape[0]
+        if attention_mask is not None and attention_mask.dim() == 2:
+            self.non_padding_tokens += int(attention_mask.sum())
+        elif self.pad_token_id is not None:
+            self.non_padding_tokens += int((input_ids != self.pad_token_id).sum())
+        else:
+            self.non_padding_tokens += input_ids.numel()
+
+    def on_train_begin(self, args, state, control, model=None, processing_class=None, **kwargs):
+        if self.pad_token_id is None:
+            tokenizer = processing_class if processing_class is not None else kwargs.get("tokenizer")
+            self.pad_token_id = getattr(tokenizer, "pad_token_id", None)
+        if model is not None and self._hook is None:
+            self._hook = model.register_forward_pre_hook(self._count_inputs, with_kwargs=True)
+        if state.is_world_process_zero:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._reset_counts()
+        self._last_event = time.perf_counter()
+
+    # the batches of a step are fetched after the previous step's logging, saving and
+    # evaluation, so the clock for data waiting starts at the last of those events
+    def on_log(self, args, state, control, **kwargs):
+        self._last_event = time.perf_counter()
+
+    def on_save(self, args, state, control, **kwargs):
+        self._last_event = time.perf_counter()
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self._last_event = time.perf_counter()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._step_begin = time.perf_counter()
+        self.data_wait += self._step_begin - self._last_event
+
+    def on_step_end(self, args, state, control, **kwargs):
+        _synchronize()
+        now = time.perf_counter()
+        self.compute += now - self._step_begin
+        self._last_event = now
+        self.steps += 1
+        if self.steps >= self.every:
+            self._write(state)
+
+    def _write(self, state):
+        elapsed = self.data_wait + self.compute
+        record = {
+            "step": state.global_step,
+            "epoch": state.epoch,
+            "steps": self.steps,
+            "tokens": self.tokens,
+            "non_padding_tokens": self.non_padding_tokens,
+            "non_padding_ratio": self.non_padding_tokens / self.tokens if self.tokens else None,
+            "samples": self.samples,
+            "tokens_per_s": self.tokens / elapsed if elapsed else None,
+            "non_padding_tokens_per_s": self.non_padding_tokens / elapsed if elapsed else None,
+            "samples_per_s": self.samples / elapsed if elapsed else None,
+            "step_s": elapsed / self.steps,
+            "data_wait_s": self.data_wait / self.steps,
+            "compute_s": self.compute / self.steps,
+            "data_wait_fraction": self.data_wait / elapsed if elapsed else None,
+            "peak_rss_mb": peak_rss_mb(),
+            "accelerator_mb": accelerator_memory_mb(),
+        }
+        if state.is_world_process_zero:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(record) + "\n")
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self._reset_counts()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.steps:
+            self._write(state)
+        if self._hook is not None:
+            self._hook.remove()
+            self._hook = None
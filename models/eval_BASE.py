@@ -7,6 +7,8 @@ from datasets import load_dataset
 import re
 import wandb
 import os
+from generation import answer_complete, generate_batched, generate_continuous
+from pass_at_k import mean_pass_at_k
 
 
 os.environ["WANDB_MODE"] = "offline"
@@ -209,38 +211,52 @@ gsm8k_test = load_dataset("gsm8k","main", split="test")
 # Assuming model and tokenizer are already initialized
 model.eval()  # Set the model to evaluation mode
 
-# Helper function to encode inputs
-def prepare_input(p):
-    # print(question)
-    prompt = (PREAMBLE +'\n\n' + PROMPT + '\n' +
+# Prompts per generate call, sorted by length and left padded. 1 runs one problem at a time
+batch_size = 16
+# The 8-shot prefix all prompts share is encoded once and its key/value cache reused for every batch
+prefix_cache = True
+# Each problem stops as soon as it has written "The answer is N." or starts a new "Q:"
+stop = answer_complete
+# Keep batch_size sequences decoding and start the next problem as soon as one finishes,
+# instead of waiting for the slowest problem of each batch
+continuous_batching = True
+# Completions per problem. 1 is greedy pass@1; above 1 they are sampled, sharing each
+# problem's prefill, and pass@k is reported for every k below from the same samples
+num_samples = 1
+temperature = 0.7
+pass_at_ks = [1, 5, 10, 20, 50, 100]
+
+# Helper function to build the prompt for a question
+def make_prompt(p):
+    return (PREAMBLE +'\n\n' + PROMPT + '\n' +
                  TEMPLATE.format(p))
-    return tokenizer(prompt, return_tensors='pt').input_ids
 
-# Function to decode model output
-def decode_output(output_ids):
-    return tokenizer.decode(output_ids, skip_special_tokens=True)
 
-
-# Manual testing loop
+# Testing loop, problems are scored and logged one by one as they finish
 all_correct = 0
 all_responses = {}
-idx = 0
 total = len(gsm8k_test)
 # total = 100
 
-for task_id, problem in enumerate(gsm8k_test, start=1):
-    if idx == total:
-        break
-    
+prompts = [make_prompt(problem['question']) for problem in gsm8k_test.select(range(total))]
+sampling = dict(num_return_sequences = num_samples, do_sample = num_samples > 1, temperature = temperature, seed = 3407)
+if continuous_batching:
+    outputs = generate_continuous(model, tokenizer, prompts, slots = batch_size, max_new_tokens = 120, prefix_cache = prefix_cache, stop = stop, **sampling)
+else:
+    outputs = generate_batched(model, tokenizer, prompts, batch_size = batch_size, max_new_tokens = 120, prefix_cache = prefix_cache, stop = stop, **sampling)  # Adjust max_new_tokens as needed
+
+# number of correct samples of every problem so far, and of problems with all samples in
+correct_samples = {}
+finished_counts = []
+done = 0
+
+for index, completion in outputs:
+    task_id = index + 1
+    problem = gsm8k_test[index]
     print(f"task_id {task_id}")
 
-    # Prepare the input for the model
-    input_ids = prepare_input(problem['question'])
-    with torch.no_grad():
-        output_ids = model.generate(input_ids, max_new_tokens = 120)  # Adjust max_length as needed
-
-    response = decode_output(output_ids[0])
-    all_responses[task_id] = response
+    response = prompts[index] + completion
+    all_responses.setdefault(task_id, []).append(response)
     
     answer_line = extract_response_after_question(response, problem['question'])
 
@@ -251,23 +267,31 @@ for task_id, problem in enumerate(gsm8k_test, start=1):
     # print(model_number)
     # print(ground_truth_number)
     
-    if model_number == ground_truth_number:
-        all_correct += 1
-    
-
+    correct_samples[task_id] = correct_samples.get(task_id, 0) + (model_number == ground_truth_number)
     print(f"Model answer: {model_number}")
     print(f"Ground truth answer: {ground_truth_number}")
-    print(f"Correct: {all_correct} out of {total}")
+    if len(all_responses[task_id]) < num_samples:
+        continue
+
+    # all samples of this problem are in, a fraction correct counts towards pass@1
+    done += 1
+    finished_counts.append(correct_samples[task_id])
+    all_correct += correct_samples[task_id] / num_samples
+    pass_at_k = mean_pass_at_k(finished_counts, num_samples, pass_at_ks)
+
+    print(f"Correct: {all_correct:g} out of {total}")
     print("="*40)
     wandb.log(
             {
                 "total_correct": all_correct,
-                "current_pct_correct": all_correct / task_id,
+                "current_pct_correct": all_correct / done,
+                **{f"pass@{k}": value for k, value in pass_at_k.items()},
             }
         )
-    idx += 1
     
 
 # Final accuracy
 accuracy = all_correct / len(gsm8k_test)
-print(f"Final Accuracy: {accuracy:.2f}")
\ No newline at end of file
+print(f"Final Accuracy: {accuracy:.2f}")
+for k, value in mean_pass_at_k(finished_counts, num_samples, pass_at_ks).items():
+    print(f"pass@{k}: {value:.4f}")
\ No newline at end of file
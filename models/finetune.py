@@ -50,36 +50,68 @@ alpaca_prompt = """Below is an instruction that describes a task, paired with an
 ### Response:
 {}"""
 
-EOS_TOKEN = tokenizer.eos_token
-def formatting_prompts_func(examples):
-    instructions = examples["instruction"]
-    inputs       = examples["input"]
-    outputs      = examples["output"]
-    texts = []
-    for instruction, input, output in zip(instructions, inputs, outputs):
-        # Must add EOS_TOKEN, otherwise your generation will go on forever!
-        text = alpaca_prompt.format(instruction, input, output) + EOS_TOKEN
-        texts.append(text)
-    return { "text" : texts, }
-pass
-
 from datasets import load_dataset
+from pretokenize import pretokenize
 dataset = load_dataset("yahma/alpaca-cleaned", split = "train")
-dataset = dataset.map(formatting_prompts_func, batched = True,)
+# Formats with alpaca_prompt (+ EOS, otherwise generation will go on forever!) and tokenizes once,
+# later runs load the cached token ids as long as the tokenizer, template and dataset are unchanged
+dataset = pretokenize(
+    dataset,
+    tokenizer,
+    alpaca_prompt,
+    fields = ["instruction", "input", "output"],
+    max_length = max_seq_length,
+)
+
+from packing import PackedDataset, PackingCollator
+# Most traces are a few hundred tokens, so several examples share each sequence. Position ids
+# restart per example, which keeps them from attending to each other
+dataset = PackedDataset(dataset, max_seq_length)
+print(dataset.report(batch_size = 2))
 
 from trl import SFTTrainer
 from transformers import TrainingArguments
+from torch.utils.data import DataLoader
+from sampler import TokenBudgetBatchSampler
+from callbacks import ThroughputCallback
+
+from mmm import MMMCollator, digit_token_table, mask_token_id
+data_collator = PackingCollator(tokenizer.pad_token_id)
+# Masked Maths Modelling: every number in the input is masked and its digits are predicted
+use_mmm = False
+if use_mmm:
+    data_collator = MMMCollator(digit_token_table(tokenizer), mask_token_id(tokenizer), data_collator, lm_labels = True)
+
+# Batches are filled up to a token budget instead of a fixed number of sequences, so every
+# optimizer step sees about max_tokens_per_batch * gradient_accumulation_steps tokens
+max_tokens_per_batch = 2 * max_seq_length
+
+class TokenBudgetTrainer(SFTTrainer):
+    def get_train_dataloader(self):
+        sampler = TokenBudgetBatchSampler(self.train_dataset.lengths(), max_tokens_per_batch, seed = self.args.seed)
+        print(sampler.stats())
+        loader = DataLoader(
+            self.train_dataset,
+            batch_sampler = sampler,
+            collate_fn = self.data_collator,
+            num_workers = self.args.dataloader_num_workers,
+            pin_memory = self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(loader)
 
-trainer = SFTTrainer(
+trainer = TokenBudgetTrainer(
     model = model,
     tokenizer = tokenizer,
     train_dataset = dataset,
     dataset_text_field = "text",
     max_seq_length = max_seq_length,
     dataset_num_proc = 2,
-    packing = False, # Can make training 5x faster for short sequences.
+    packing = False, # Already packed by PackedDataset
+    data_collator = data_collator,
+    # tokens/s, padding, data wait vs compute and peak memory for every step
+    callbacks = [ThroughputCallback("outputs/throughput.jsonl")],
     args = TrainingArguments(
-        per_device_train_batch_size = 2,
+        per_device_train_batch_size = 2, # Unused, batches follow max_tokens_per_batch
         gradient_accumulation_steps = 4,
         warmup_steps = 5,
         # max_steps = 60,
@@ -0,0 +1,540 @@
+"""
+Batched generation for the GSM8K eval scripts.
+
+Prompts are tokenized up front, grouped into batches of similar length (longest first, so
+running out of memory shows up on the first batch) and left padded, so every row's
+completion starts at the same column and can be cut off after the prompt.
+
+The tokens all prompts start with (the few-shot block of the eval prompts) are run through
+the model once and their key/value cache is copied into every batch, so each batch only
+prefills its own questions. The padding then sits between the shared prefix and the
+questions; position ids, which come from the attention mask, still run on from the
+prefix in every row.
+
+Decoding runs its own loop over the model's forward pass rather than model.generate, so
+each row can end on its own as soon as it has written its answer (answer_complete), and
+finished rows are dropped from the batch and its cache instead of decoding padding until
+the slowest row is done.
+
+    for index, completion in generate_batched(model, tokenizer, prompts, batch_size=16):
+        ...
+"""
+
+import copy
+import re
+from collections import deque
+
+import torch
+from transformers import DynamicCache, StoppingCriteria
+
+
+def length_sorted_batches(lengths, batch_size):
+    """
+    Splits indices into batches of batch_size, sorted from longest to shortest length
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    return [order[start : start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def left_pad(sequences, pad_token_id):
+    """
+    Left pads lists of token ids to the longest one, returns (input_ids, attention_mask)
+    """
+    length = max(len(ids) for ids in sequences)
+    input_ids = torch.full((len(sequences), length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), length), dtype=torch.long)
+    for row, ids in enumerate(sequences):
+        if ids:
+            input_ids[row, -len(ids) :] = torch.as_tensor(ids, dtype=torch.long)
+            attention_mask[row, -len(ids) :] = 1
+    return input_ids, attention_mask
+
+
+def shared_prefix_length(sequences):
+    """
+    Number of leading tokens all sequences have in common
+    """
+    first = sequences[0]
+    length = min(len(ids) for ids in sequences)
+    for ids in sequences[1:]:
+        for i in range(length):
+            if ids[i] != first[i]:
+                length = i
+                break
+    return length
+
+
+class PrefixCache:
+    """
+    Key/value cache of a token prefix, computed once per model and copied for every batch
+    of prompts that starts with it
+    """
+
+    def __init__(self, model, prefix_ids):
+        self.prefix_ids = list(prefix_ids)
+        with torch.no_grad():
+            input_ids = torch.as_tensor([self.prefix_ids], dtype=torch.long, device=model.device)
+            self.cache = model(input_ids=input_ids, use_cache=True).past_key_values
+
+    def __len__(self):
+        return len(self.prefix_ids)
+
+    def expand(self, batch_size):
+        """
+        A fresh copy of the cache repeated batch_size times, for decoding to extend
+        """
+        cache = copy.deepcopy(self.cache)
+        cache.batch_repeat_interleave(batch_size)
+        return cache
+
+
+# "The answer is N." as read by extract_number_from_text in the eval scripts. The period
+# must be followed by whitespace, otherwise "1." could still become "1.5"
+ANSWER_PATTERN = re.compile(r"The answer is[^\n]*?\d(?:\.\d+)?\s*(?:\.\s|\n)")
+# the model moving on to a new few-shot question
+NEW_QUESTION_PATTERN = re.compile(r"\nQ:")
+
+
+def answer_complete(text):
+    """
+    True once a completion has given its answer or started a new question
+    """
+    return ANSWER_PATTERN.search(text) is not None or NEW_QUESTION_PATTERN.search(text) is not None
+
+
+class AnswerStoppingCriteria(StoppingCriteria):
+    """
+    Stopping criteria for model.generate that ends each row on its own once
+    answer_complete matches the text it generated after prompt_length tokens
+    """
+
+    def __init__(self, tokenizer, prompt_length, stop=answer_complete):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stop = stop
+
+    def __call__(self, input_ids, scores, **kwargs):
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length :], skip_special_tokens=True)
+        return torch.tensor([self.stop(text) for text in texts], dtype=torch.bool, device=input_ids.device)
+
+
+def next_tokens(logits, do_sample=False, temperature=1.0, top_p=1.0, generator=None):
+    """
+    Picks the next token of every row from its last position logits, greedily or by
+    sampling with temperature and nucleus (top_p) filtering
+    """
+    if not do_sample:
+        return logits.argmax(dim=-1)
+    logits = logits.float() / temperature
+    if top_p < 1.0:
+        sorted_logits, order = logits.sort(dim=-1, descending=True)
+        cumulative = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        # drop tokens once the ones before them already cover top_p
+        drop = cumulative - sorted_logits.softmax(dim=-1) >= top_p
+        logits = logits.scatter(-1, order, sorted_logits.masked_fill(drop, float("-inf")))
+    probs = logits.softmax(dim=-1)
+    return torch.multinomial(probs.cpu(), 1, generator=generator).squeeze(-1).to(logits.device)
+
+
+def decode_batch(
+    model,
+    tokenizer,
+    input_ids,
+    attention_mask,
+    past_key_values=None,
+    max_new_tokens=120,
+    stop=None,
+    do_sample=False,
+    temperature=1.0,
+    top_p=1.0,
+    generator=None,
+    num_return_sequences=1,
+):
+    """
+    Generates for a padded batch and returns the new token ids of every row. A row is done
+    at the EOS token, after max_new_tokens, or once stop(its decoded completion) is true,
+    and done rows are dropped from the batch and the cache, so they stop costing compute.
+    past_key_values may already hold the first tokens of input_ids (see PrefixCache).
+    With num_return_sequences each prompt is prefilled once and its cache copied for that
+    many samples; sample s of row i is returned at i * num_return_sequences + s.
+    """
+    device = model.device
+    input_ids = input_ids.to(device)
+    attention_mask = attention_mask.to(device)
+    cached = past_key_values.get_seq_length() if past_key_values is not None else 0
+    if past_key_values is None:
+        past_key_values = DynamicCache()
+    position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+    outputs = [[] for _ in range(len(input_ids) * num_return_sequences)]
+    rows = torch.arange(len(outputs), device=device)
+    step_ids = input_ids[:, cached:]
+    step_positions = position_ids[:, cached:]
+    with torch.no_grad():
+        for step in range(max_new_tokens):
+            logits = model(
+                input_ids=step_ids,
+                attention_mask=attention_mask,
+                position_ids=step_positions,
+                past_key_values=past_key_values,
+                use_cache=True,
+            ).logits[:, -1]
+            if step == 0 and num_return_sequences > 1:
+                past_key_values.batch_repeat_interleave(num_return_sequences)
+                logits = logits.repeat_interleave(num_return_sequences, dim=0)
+                attention_mask = attention_mask.repeat_interleave(num_return_sequences, dim=0)
+                step_positions = step_positions.repeat_interleave(num_return_sequences, dim=0)
+            tokens = next_tokens(logits, do_sample, temperature, top_p, generator)
+
+            keep = []
+            for i, (row, token) in enumerate(zip(rows.tolist(), tokens.tolist())):
+                if token == tokenizer.eos_token_id:
+                    continue
+                outputs[row].append(token)
+                if stop is not None and stop(tokenizer.decode(outputs[row], skip_special_tokens=True)):
+                    continue
+                keep.append(i)
+            if not keep:
+                break
+            if len(keep) < len(rows):
+                keep = torch.tensor(keep, device=device)
+                past_key_values.batch_select_indices(keep)
+                rows, tokens, attention_mask = rows[keep], tokens[keep], attention_mask[keep]
+                step_positions = step_positions[keep]
+
+            step_ids = tokens[:, None]
+            step_positions = step_positions[:, -1:] + 1
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(rows), 1))], dim=1)
+    return outputs
+
+
+def resolve_prefix_cache(model, encoded, prefix_cache):
+    """
+    The PrefixCache to use for prompts tokenized as encoded: prefix_cache itself, a new one
+    for their shared tokens if it is True, or None if it is False or None
+    """
+    if prefix_cache is True:
+        # keep at least one token per prompt for the first decoding step
+        shared = min(shared_prefix_length(encoded), min(len(ids) for ids in encoded) - 1)
+        prefix_cache = PrefixCache(model, encoded[0][:shared]) if shared > 0 else None
+    prefix = prefix_cache.prefix_ids if prefix_cache else []
+    if any(ids[: len(prefix)] != prefix or len(ids) == len(prefix) for ids in encoded):
+        raise ValueError("Every prompt must start with the cached prefix and have tokens after it")
+    return prefix_cache or None
+
+
+def generate_batched(
+    model,
+    tokenizer,
+    prompts,
+    batch_size=16,
+    max_new_tokens=120,
+    prefix_cache=True,
+    stop=None,
+    do_sample=False,
+    temperature=1.0,
+    top_p=1.0,
+    seed=None,
+    num_return_sequences=1,
+):
+    """
+    Generates for prompts in length sorted batches and yields (prompt index, completion
+    text) as each batch finishes, in batch order rather than prompt order. With
+    num_return_sequences every prompt is prefilled once and yielded that many times, one
+    per sample, with batch_size counting prompts.
+
+    prefix_cache  True caches the tokens shared by all prompts once, a PrefixCache reuses
+                  one from an earlier call (every prompt must start with its tokens),
+                  False prefills every prompt in full
+    stop          function of a row's completion text that ends that row, e.g.
+                  answer_complete
+    do_sample, temperature, top_p and seed control sampling, the default is greedy.
+    """
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    encoded = [tokenizer(prompt)["input_ids"] for prompt in prompts]
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+
+    prefix_cache = resolve_prefix_cache(model, encoded, prefix_cache)
+    prefix = prefix_cache.prefix_ids if prefix_cache else []
+
+    for batch in length_sorted_batches([len(ids) for ids in encoded], batch_size):
+        suffix_ids, suffix_mask = left_pad([encoded[i][len(prefix) :] for i in batch], pad_token_id)
+        prefix_ids = torch.as_tensor(prefix, dtype=torch.long).expand(len(batch), len(prefix))
+        input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+        attention_mask = torch.cat([torch.ones_like(prefix_ids), suffix_mask], dim=1)
+        completions = decode_batch(
+            model,
+            tokenizer,
+            input_ids,
+            attention_mask,
+            past_key_values=prefix_cache.expand(len(batch)) if prefix_cache else None,
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            do_sample=do_sample,
+            temperature=temperature,
+            top_p=top_p,
+            generator=generator,
+            num_return_sequences=num_return_sequences,
+        )
+        indices = [index for index in batch for _ in range(num_return_sequences)]
+        yield from zip(indices, tokenizer.batch_decode(completions, skip_special_tokens=True))
+
+
+def _pad_cache_left(cache, columns):
+    for layer in cache.layers:
+        layer.keys = torch.nn.functional.pad(layer.keys, (0, 0, columns, 0))
+        layer.values = torch.nn.functional.pad(layer.values, (0, 0, columns, 0))
+
+
+def _crop_cache_left(cache, columns):
+    for layer in cache.layers:
+        layer.keys = layer.keys[..., columns:, :]
+        layer.values = layer.values[..., columns:, :]
+
+
+def _concat_caches(cache, other):
+    for layer, other_layer in zip(cache.layers, other.layers):
+        layer.keys = torch.cat([layer.keys, other_layer.keys])
+        layer.values = torch.cat([layer.values, other_layer.values])
+
+
+class ContinuousBatcher:
+    """
+    Continuous (in flight) batching: keeps up to slots sequences decoding together and, as
+    soon as one finishes, prefills the next waiting prompt and adds it to the running batch,
+    so a long generation never holds finished slots idle.
+
+    All rows share one key/value cache. Rows joining with a different cache length are left
+    padded with masked columns, columns that no row attends to any more are cropped, and
+    every row keeps its own position ids. This works on the per layer keys and values of
+    transformers' DynamicCache (cache.layers).
+
+    Works on token ids: prompts are lists of ids, stop is a function of a row's new token
+    ids, and run() yields (prompt index, new token ids) in the order prompts finish. A row is
+    done at eos_token_id, after max_new_tokens or once stop is true.
+
+    With num_return_sequences every prompt is prefilled once and its cache copied into that
+    many rows, which sample independently; each index is then yielded once per sample.
+    """
+
+    def __init__(
+        self,
+        model,
+        slots=16,
+        max_new_tokens=120,
+        eos_token_id=None,
+        pad_token_id=0,
+        prefix_cache=None,
+        stop=None,
+        do_sample=False,
+        temperature=1.0,
+        top_p=1.0,
+        generator=None,
+        num_return_sequences=1,
+    ):
+        self.model = model
+        self.slots = slots
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.prefix_cache = prefix_cache
+        self.stop = stop
+        self.sampling = {"do_sample": do_sample, "temperature": temperature, "top_p": top_p, "generator": generator}
+        self.num_return_sequences = num_return_sequences
+
+    def _prefill(self, prompts):
+        """
+        Runs new prompts, returns (cache, attention_mask, next positions, last logits)
+        """
+        device = self.model.device
+        prefix = self.prefix_cache.prefix_ids if self.prefix_cache else []
+        suffix_ids, suffix_mask = left_pad([ids[len(prefix) :] for ids in prompts], self.pad_token_id)
+        attention_mask = torch.cat([torch.ones((len(prompts), len(prefix)), dtype=torch.long), suffix_mask], dim=1)
+        attention_mask = attention_mask.to(device)
+        positions = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)[:, len(prefix) :]
+        cache = self.prefix_cache.expand(len(prompts)) if self.prefix_cache else DynamicCache()
+        logits = self.model(
+            input_ids=suffix_ids.to(device),
+            attention_mask=attention_mask,
+            position_ids=positions,
+            past_key_values=cache,
+            use_cache=True,
+        ).logits[:, -1]
+        next_positions = positions[:, -1] + 1
+        if self.num_return_sequences > 1:
+            samples = self.num_return_sequences
+            cache.batch_repeat_interleave(samples)
+            attention_mask = attention_mask.repeat_interleave(samples, dim=0)
+            next_positions = next_positions.repeat_interleave(samples, dim=0)
+            logits = logits.repeat_interleave(samples, dim=0)
+        return cache, attention_mask, next_positions, logits
+
+    def _accept(self, rows, tokens, outputs):
+        """
+        Records each row's new token, returns the positions of the rows still running
+        """
+        keep = []
+        for i, (row, token) in enumerate(zip(rows, tokens.tolist())):
+            if token == self.eos_token_id:
+                continue
+            outputs[row].append(token)
+            if len(outputs[row]) >= self.max_new_tokens or (self.stop is not None and self.stop(outputs[row])):
+                continue
+            keep.append(i)
+        return keep
+
+    def run(self, prompts):
+        queue = deque(range(len(prompts)))
+        outputs = {}
+        rows = []
+        cache = mask = positions = tokens = None
+        with torch.no_grad():
+            while queue or rows:
+                finished = []
+                samples = self.num_return_sequences
+                # a prompt whose samples need more than every slot still runs on its own
+                room = max(self.slots - len(rows), 0 if rows else samples) // samples
+                if queue and room:
+                    indices = [queue.popleft() for _ in range(min(room, len(queue)))]
+                    new_cache, new_mask, new_positions, logits = self._prefill([prompts[i] for i in indices])
+                    # a row is (prompt index, sample number)
+                    admitted = [(index, sample) for index in indices for sample in range(samples)]
+                    for row in admitted:
+                        outputs[row] = []
+                    new_tokens = next_tokens(logits, **self.sampling)
+                    keep = self._accept(admitted, new_tokens, outputs)
+                    finished += [index for i, index in enumerate(admitted) if i not in keep]
+                    if keep:
+                        keep_index = torch.tensor(keep, device=new_mask.device)
+                        new_cache.batch_select_indices(keep_index)
+                        new_mask, new_positions = new_mask[keep_index], new_positions[keep_index]
+                        new_tokens = new_tokens[keep_index]
+                        admitted = [admitted[i] for i in keep]
+                        if rows:
+                            width = max(mask.shape[1], new_mask.shape[1])
+                            _pad_cache_left(cache, width - mask.shape[1])
+                            _pad_cache_left(new_cache, width - new_mask.shape[1])
+                            mask = torch.cat([mask.new_zeros((len(rows), width - mask.shape[1])), mask], dim=1)
+                            new_mask = torch.cat([new_mask.new_zeros((len(admitted), width - new_mask.shape[1])), new_mask], dim=1)
+                            _concat_caches(cache, new_cache)
+                            mask = torch.cat([mask, new_mask])
+                            positions = torch.cat([positions, new_positions])
+                            tokens = torch.cat([tokens, new_tokens])
+                        else:
+                            cache, mask, positions, tokens = new_cache, new_mask, new_positions, new_tokens
+                        rows += admitted
+
+                if rows:
+                    mask = torch.cat([mask, mask.new_ones((len(rows), 1))], dim=1)
+                    logits = self.model(
+                        input_ids=tokens[:, None],
+                        attention_mask=mask,
+                        position_ids=positions[:, None],
+                        past_key_values=cache,
+                        use_cache=True,
+                    ).logits[:, -1]
+                    positions = positions + 1
+                    tokens = next_tokens(logits, **self.sampling)
+                    keep = self._accept(rows, tokens, outputs)
+                    finished += [row for i, row in enumerate(rows) if i not in keep]
+                    if len(keep) < len(rows):
+                        keep_index = torch.tensor(keep, dtype=torch.long, device=mask.device)
+                        cache.batch_select_indices(keep_index)
+                        mask, positions, tokens = mask[keep_index], positions[keep_index], tokens[keep_index]
+                        rows = [rows[i] for i in keep]
+                        # drop the columns only finished rows attended to
+                        unused = int((mask.sum(dim=0) == 0).int().cumprod(dim=0).sum())
+                        if rows and unused:
+                            _crop_cache_left(cache, unused)
+                            mask = mask[:, unused:]
+
+                for row in finished:
+                    yield row[0], outputs.pop(row)
+
+
+def generate_continuous(
+    model,
+    tokenizer,
+    prompts,
+    slots=16,
+    max_new_tokens=120,
+    prefix_cache=True,
+    stop=None,
+    do_sample=False,
+    temperature=1.0,
+    top_p=1.0,
+    seed=None,
+    num_return_sequences=1,
+):
+    """
+    Like generate_batched, but decodes with a ContinuousBatcher of slots rows, yielding
+    (prompt index, completion text) as each prompt, or each of its num_return_sequences
+    samples, finishes
+    """
+    encoded = [tokenizer(prompt)["input_ids"] for prompt in prompts]
+    batcher = ContinuousBatcher(
+        model,
+        slots=slots,
+        max_new_tokens=max_new_tokens,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+        prefix_cache=resolve_prefix_cache(model, encoded, prefix_cache),
+        stop=None if stop is None else (lambda ids: stop(tokenizer.decode(ids, skip_special_tokens=True))),
+        do_sample=do_sample,
+        temperature=temperature,
+        top_p=top_p,
+        generator=torch.Generator().manual_seed(seed) if seed is not None else None,
+        num_return_sequences=num_return_sequences,
+    )
+    for index, ids in batcher.run(encoded):
+        yield index, tokenizer.decode(ids, skip_special_tokens=True)
+
+
+if __name__ == "__main__":
+    import argparse
+    import random
+    import time
+
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    parser = argparse.ArgumentParser(description="Check continuous batching against one prompt at a time on a tiny random model")
+    parser.add_argument("--prompts", type=int, default=64)
+    parser.add_argument("--slots", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=100)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    model = LlamaForCausalLM(config).eval()
+    rng = random.Random(0)
+    shared = [rng.randrange(3, 64) for _ in range(40)]
+    prompts = [shared + [rng.randrange(3, 64) for _ in range(rng.randint(1, 30))] for _ in range(args.prompts)]
+
+    # ends rows after very different numbers of tokens
+    def stop(ids):
+        return sum(ids[-2:]) % 13 == 0
+
+    calls = [0]
+    model.register_forward_pre_hook(lambda module, inputs: calls.__setitem__(0, calls[0] + 1))
+    settings = {"max_new_tokens": args.max_new_tokens, "eos_token_id": config.eos_token_id, "stop": stop}
+    expected = [dict(ContinuousBatcher(model, slots=1, **settings).run([ids]))[0] for ids in prompts]
+
+    for prefix_cache in (None, PrefixCache(model, shared)):
+        calls[0] = 0
+        start = time.perf_counter()
+        batcher = ContinuousBatcher(model, slots=args.slots, prefix_cache=prefix_cache, **settings)
+        outputs = dict(batcher.run(prompts))
+        elapsed = time.perf_counter() - start
+        matches = sum(outputs[i] == expected[i] for i in range(len(prompts)))
+        tokens = sum(len(ids) for ids in outputs.values())
+        print(
+            f"prefix cache {prefix_cache is not None}: {matches}/{len(prompts)} match one at a time, "
+            f"{calls[0]} forward passes, {tokens / elapsed:,.0f} tokens/s"
+        )
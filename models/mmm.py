@@ -0,0 +1,144 @@
+"""
+Masked Maths Modelling (MMM).
+
+Like masked language modelling, but what gets masked is whole numbers: every run of digit
+tokens is replaced by the mask token and the model is trained to predict the full digit
+sequence. Digit tokens are found with a lookup table over the vocabulary built once from
+the tokenizer, and masking is done with tensor operations over the whole batch, so it costs
+about the same as padding the batch.
+
+    collator = MMMCollator(digit_token_table(tokenizer), mask_token_id(tokenizer), PackingCollator(tokenizer.pad_token_id))
+"""
+
+import torch
+
+
+def digit_token_table(tokenizer):
+    """
+    Boolean tensor over the vocabulary that is True for tokens made only of digits,
+    ignoring the leading space marker of sentencepiece and byte level vocabularies
+    """
+    vocab = tokenizer.get_vocab()
+    table = torch.zeros(max(len(tokenizer), max(vocab.values()) + 1), dtype=torch.bool)
+    for token, token_id in vocab.items():
+        text = token.lstrip("▁Ġ ")
+        table[token_id] = text.isascii() and text.isdigit()
+    return table
+
+
+def mask_token_id(tokenizer):
+    """
+    The tokenizer's mask token, or its unknown token for causal models that have none
+    """
+    if tokenizer.mask_token_id is not None:
+        return tokenizer.mask_token_id
+    if tokenizer.unk_token_id is not None:
+        return tokenizer.unk_token_id
+    raise ValueError("Tokenizer has neither a mask nor an unknown token, pass mask_token_id explicitly")
+
+
+def number_spans(input_ids, digit_table, position_ids=None):
+    """
+    Returns (is_digit, span_ids): which tokens are digits, and for every token the number of
+    digit runs that started at or before it in its row, so all digits of one number share a
+    span id. With position_ids of packed rows, runs never continue across an example boundary.
+    """
+    is_digit = digit_table.to(input_ids.device)[input_ids]
+    previous = torch.zeros_like(is_digit)
+    previous[:, 1:] = is_digit[:, :-1]
+    if position_ids is not None:
+        previous &= position_ids != 0
+    starts = is_digit & ~previous
+    return is_digit, starts.cumsum(dim=1)
+
+
+def mask_numbers(
+    input_ids,
+    digit_table,
+    mask_token_id,
+    labels=None,
+    position_ids=None,
+    maskable=None,
+    mask_probability=1.0,
+    lm_labels=False,
+    generator=None,
+    ignore_index=-100,
+):
+    """
+    Masks whole numbers in a [batch, length] tensor of token ids. Each number is masked
+    with mask_probability. Returns (masked_input_ids, labels) where labels hold the original
+    digit ids at masked positions. With lm_labels the other positions keep their ordinary
+    language modelling labels (from labels, or input_ids if not given), otherwise they are
+    ignore_index.
+
+    maskable is an optional boolean tensor of the positions that may be masked and get
+    labels. A number is masked whole if any of its digits is maskable, so a number starting
+    at an ignored position (e.g. the first token of a packed example) is never split, but
+    only its maskable digits get labels.
+    """
+    is_digit, span_ids = number_spans(input_ids, digit_table, position_ids)
+    num_spans = int(span_ids.max()) + 1 if span_ids.numel() else 1
+    if maskable is None:
+        masked = is_digit
+    else:
+        hits = torch.zeros((input_ids.shape[0], num_spans), dtype=torch.long, device=input_ids.device)
+        hits.scatter_add_(1, span_ids, (is_digit & maskable).long())
+        masked = is_digit & (hits.gather(1, span_ids) > 0)
+    if mask_probability < 1.0:
+        draws = torch.rand((input_ids.shape[0], num_spans), generator=generator).to(input_ids.device)
+        masked &= draws.gather(1, span_ids) < mask_probability
+
+    if lm_labels:
+        base = input_ids if labels is None else labels
+    else:
+        base = torch.full_like(input_ids, ignore_index)
+    labelled = masked if maskable is None else masked & maskable
+    new_labels = torch.where(labelled, input_ids, base)
+    masked_input_ids = input_ids.masked_fill(masked, mask_token_id)
+    return masked_input_ids, new_labels
+
+
+class MMMCollator:
+    """
+    Wraps a padding collator (e.g. PackingCollator or DataCollatorForLanguageModeling) and
+    applies mask_numbers to the padded batch. Positions the base collator set to ignore_index
+    in its labels (padding, the first token of each packed example) never get labels, and
+    numbers made only of such positions are left as they are.
+    """
+
+    def __init__(
+        self,
+        digit_table,
+        mask_token_id,
+        base_collator,
+        mask_probability=1.0,
+        lm_labels=False,
+        seed=None,
+        ignore_index=-100,
+    ):
+        self.digit_table = digit_table
+        self.mask_token_id = mask_token_id
+        self.base_collator = base_collator
+        self.mask_probability = mask_probability
+        self.lm_labels = lm_labels
+        self.ignore_index = ignore_index
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator().manual_seed(seed)
+
+    def __call__(self, features):
+        batch = self.base_collator(features)
+        labels = batch.get("labels")
+        batch["input_ids"], batch["labels"] = mask_numbers(
+            batch["input_ids"],
+            self.digit_table,
+            self.mask_token_id,
+            labels=labels,
+            position_ids=batch.get("position_ids"),
+            maskable=None if labels is None else labels != self.ignore_index,
+            mask_probability=self.mask_probability,
+            lm_labels=self.lm_labels,
+            generator=self.generator,
+            ignore_index=self.ignore_index,
+        )
+        return batch
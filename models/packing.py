@@ -0,0 +1,203 @@
+"""
+Boundary aware sequence packing.
+
+Short examples are packed several to a sequence with first-fit-decreasing bin packing on
+their token lengths. Position ids restart at 0 for every example and labels are masked at
+each example's first token, so no example predicts or attends across a boundary:
+transformers builds a block diagonal mask from the restarting position ids when neither an
+attention_mask nor a cache is passed, so PackingCollator leaves out the mask and sets
+use_cache=False (models such as Llama otherwise create a cache even in training), or
+PackingCollator(boundaries="mask") builds the mask explicitly.
+
+    dataset = PackedDataset(pretokenize(...), max_length=2048)
+    print(dataset.report(batch_size=2))
+    trainer = SFTTrainer(..., train_dataset=dataset, data_collator=PackingCollator(tokenizer.pad_token_id))
+"""
+
+import numpy as np
+import torch
+
+
+def first_fit_decreasing(lengths, capacity):
+    """
+    Packs items of the given lengths into bins holding at most capacity tokens. Returns a
+    list of bins, each a list of item indices. Items longer than capacity get a bin of
+    their own. Free space per bin is kept in a max segment tree, so finding the first bin
+    an item fits in takes O(log n).
+    """
+    lengths = np.minimum(np.asarray(lengths, dtype=np.int64), capacity)
+    order = np.argsort(-lengths, kind="stable")
+
+    size = 1
+    while size < max(1, len(lengths)):
+        size *= 2
+    # tree[1] is the root, the leaves tree[size:] hold the free space of bin 0, 1, ...
+    tree = [capacity] * (2 * size)
+    bins = []
+    for index in order.tolist():
+        length = int(lengths[index])
+        node = 1
+        while node < size:
+            node = 2 * node if tree[2 * node] >= length else 2 * node + 1
+        position = node - size
+        if position == len(bins):
+            bins.append([])
+        bins[position].append(index)
+
+        tree[node] -= length
+        node //= 2
+        while node:
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+            node //= 2
+    return bins
+
+
+def padding_rate(sequence_lengths, batch_size):
+    """
+    Fraction of tokens that are padding when consecutive sequences are batched and padded
+    to the longest sequence in each batch
+    """
+    lengths = np.asarray(sequence_lengths, dtype=np.int64)
+    padded = 0
+    for start in range(0, len(lengths), batch_size):
+        batch = lengths[start : start + batch_size]
+        padded += len(batch) * int(batch.max())
+    return 1 - int(lengths.sum()) / padded if padded else 0.0
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    """
+    Packs the examples of a tokenized dataset (items {"input_ids": [...]}, e.g. a
+    TokenCache) into sequences of at most max_length tokens. Each item is
+    {"input_ids": [...], "position_ids": [...]} with position ids restarting at 0 for every
+    example in it. The boundaries travel in position_ids because it is a model forward
+    argument, so the Trainer's remove_unused_columns keeps it for the collator.
+    Examples longer than max_length are truncated.
+    """
+
+    def __init__(self, dataset, max_length, lengths=None):
+        self.dataset = dataset
+        self.max_length = max_length
+        if lengths is None:
+            if hasattr(dataset, "lengths"):
+                lengths = dataset.lengths()
+            else:
+                lengths = [len(dataset[i]["input_ids"]) for i in range(len(dataset))]
+        self.example_lengths = np.minimum(np.asarray(lengths, dtype=np.int64), max_length)
+        self.bins = first_fit_decreasing(self.example_lengths, max_length)
+
+    def __len__(self):
+        return len(self.bins)
+
+    def __getitem__(self, index):
+        input_ids = []
+        position_ids = []
+        for item in self.bins[index]:
+            ids = list(self.dataset[item]["input_ids"][: self.max_length])
+            input_ids.extend(ids)
+            position_ids.extend(range(len(ids)))
+        return {"input_ids": input_ids, "position_ids": position_ids}
+
+    def lengths(self):
+        """
+        Token count of every packed sequence
+        """
+        return np.array([self.example_lengths[items].sum() for items in self.bins], dtype=np.int64)
+
+    def report(self, batch_size=1):
+        """
+        Padding rate of batches of batch_size before packing (examples in dataset order)
+        and after (packed sequences in order), both padded to the longest in the batch
+        """
+        return {
+            "examples": len(self.example_lengths),
+            "tokens": int(self.example_lengths.sum()),
+            "sequences_before": len(self.example_lengths),
+            "sequences_after": len(self.bins),
+            "padding_rate_before": padding_rate(self.example_lengths, batch_size),
+            "padding_rate_after": padding_rate(self.lengths(), batch_size),
+        }
+
+
+def block_diagonal_mask(seq_ids, dtype=None):
+    """
+    [batch, 1, length, length] causal mask letting each token attend to earlier tokens with
+    the same sequence id. Boolean (True where allowed) when dtype is None, otherwise an
+    additive mask of that float dtype (0 where allowed, the dtype's minimum elsewhere).
+    """
+    length = seq_ids.shape[1]
+    causal = torch.ones(length, length, dtype=torch.bool).tril()
+    same = seq_ids[:, :, None] == seq_ids[:, None, :]
+    allowed = (same & causal)[:, None]
+    if dtype is None:
+        return allowed
+    return torch.zeros(allowed.shape, dtype=dtype).masked_fill(~allowed, torch.finfo(dtype).min)
+
+
+class PackingCollator:
+    """
+    Pads packed sequences (items of PackedDataset, or plain {"input_ids"} items, which count
+    as a single example) to the longest in the batch and returns input_ids, labels and
+    position_ids restarting at every example. Examples start where an item's position_ids
+    are 0. Labels are -100 on padding and on the first
+    token of each example, which would otherwise be predicted from the previous example.
+
+    boundaries  "position_ids" leaves out attention_mask and sets use_cache=False so
+                transformers derives the block diagonal mask from the position ids (it
+                only does so when there is no cache, and models with use_cache=True in
+                their config create one on every forward, in training too); "mask" adds
+                an explicit [batch, 1, length, length] attention_mask, see
+                block_diagonal_mask
+    mask_dtype  None for a boolean mask (sdpa), or the model's float dtype for an
+                additive mask (eager attention)
+    """
+
+    def __init__(
+        self,
+        pad_token_id,
+        boundaries="position_ids",
+        mask_dtype=None,
+        pad_to_multiple_of=None,
+        label_pad_token_id=-100,
+    ):
+        if boundaries not in ("position_ids", "mask"):
+            raise ValueError(f"Unknown boundaries {boundaries!r}, expected 'position_ids' or 'mask'")
+        self.pad_token_id = pad_token_id
+        self.boundaries = boundaries
+        self.mask_dtype = mask_dtype
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.label_pad_token_id = label_pad_token_id
+
+    def __call__(self, features):
+        length = max(len(feature["input_ids"]) for feature in features)
+        if self.pad_to_multiple_of:
+            length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        batch_size = len(features)
+        input_ids = torch.full((batch_size, length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, length), self.label_pad_token_id, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, length), dtype=torch.long)
+        seq_ids = torch.full((batch_size, length), -1, dtype=torch.long)
+
+        for row, feature in enumerate(features):
+            ids = torch.as_tensor(feature["input_ids"], dtype=torch.long)
+            used = len(ids)
+            if "position_ids" in feature:
+                positions = torch.as_tensor(feature["position_ids"], dtype=torch.long)
+            else:
+                positions = torch.arange(used)
+            input_ids[row, :used] = ids
+            position_ids[row, :used] = positions
+
+            starts = positions == 0
+            seq_ids[row, :used] = starts.cumsum(0) - 1
+            labels[row, :used] = ids.masked_fill(starts, self.label_pad_token_id)
+            # padding gets its own positions from 0, so it reads as one more sequence
+            position_ids[row, used:] = torch.arange(length - used)
+
+        batch = {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+        if self.boundaries == "mask":
+            batch["attention_mask"] = block_diagonal_mask(seq_ids, self.mask_dtype)
+        else:
+            batch["use_cache"] = False
+        return batch
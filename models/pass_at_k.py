@@ -0,0 +1,29 @@
+"""
+Unbiased pass@k estimation.
+
+With n sampled completions for a problem of which c are correct, pass@k is estimated as
+1 - C(n - c, k) / C(n, k), the chance that at least one of k samples drawn from the n
+without replacement is correct (Chen et al. 2021, "Evaluating Large Language Models
+Trained on Code"). Every k up to n comes from the same n samples, so one sampling run
+reports them all.
+"""
+
+import numpy as np
+
+
+def pass_at_k(n, c, k):
+    """
+    Unbiased pass@k for one problem with c correct out of n samples
+    """
+    if n - c < k:
+        return 1.0
+    # 1 - C(n - c, k) / C(n, k) as a product, which stays stable for large n
+    return 1.0 - float(np.prod(1.0 - k / np.arange(n - c + 1, n + 1)))
+
+
+def mean_pass_at_k(correct_counts, n, ks):
+    """
+    pass@k averaged over problems, for every k in ks that is at most n. correct_counts holds
+    the number of correct samples of each problem.
+    """
+    return {k: float(np.mean([pass_at_k(n, c, k) for c in correct_counts])) for k in ks if k <= n}
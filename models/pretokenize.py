@@ -0,0 +1,185 @@
+"""
+Pre-tokenized dataset cache.
+
+Formats every example with a prompt template, tokenizes it once and stores the token ids as
+flat memory mapped arrays under cache_dir/<key>/:
+    tokens.bin   int32 token ids of every example back to back
+    offsets.bin  int64 example boundaries, n + 1 of them
+    meta.json    what the cache was built from
+The key is a hash of the tokenizer, the template and the dataset version, so later runs
+reuse the cache without any preprocessing and changing any of the three builds a new one.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+
+CACHE_FORMAT = 1
+
+META_NAME = "meta.json"
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    Hash of everything that decides how a tokenizer splits text
+    """
+    digest = hashlib.sha256()
+    digest.update(type(tokenizer).__name__.encode("utf-8"))
+    if hasattr(tokenizer, "backend_tokenizer"):
+        # fast tokenizers serialise their full vocab, merges and normalizers
+        digest.update(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    else:
+        for token, token_id in sorted(tokenizer.get_vocab().items(), key=lambda item: item[1]):
+            digest.update(f"{token_id}:{token}\n".encode("utf-8"))
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def dataset_fingerprint(dataset):
+    """
+    Best effort version string for a dataset: the Hugging Face fingerprint if it has one
+    """
+    fingerprint = getattr(dataset, "_fingerprint", None)
+    if fingerprint is None:
+        raise ValueError("Dataset has no fingerprint, pass dataset_version explicitly")
+    return fingerprint
+
+
+def cache_key(tokenizer, template, fields, dataset_version, add_eos=True, max_length=None):
+    """
+    Hash identifying a cache, built from everything that changes its contents
+    """
+    parts = {
+        "format": CACHE_FORMAT,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "template": template,
+        "fields": list(fields),
+        "dataset": dataset_version,
+        "add_eos": add_eos,
+        "max_length": max_length,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class TokenCache(torch.utils.data.Dataset):
+    """
+    Memory mapped token ids of a built cache. Indexing returns {"input_ids": [...]}, which the
+    default language modelling collators pad and turn into labels.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_NAME), encoding="utf-8") as file:
+            self.meta = json.load(file)
+        self.offsets = np.memmap(os.path.join(path, "offsets.bin"), dtype=np.int64, mode="r")
+        if self.offsets[-1] > 0:
+            self.tokens = np.memmap(os.path.join(path, "tokens.bin"), dtype=np.int32, mode="r")
+        else:
+            self.tokens = np.empty(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def token_ids(self, index):
+        """
+        Token ids of one example as a zero copy view into the mapped file
+        """
+        return self.tokens[self.offsets[index] : self.offsets[index + 1]]
+
+    def lengths(self):
+        """
+        Token count of every example, without reading any tokens
+        """
+        return np.diff(self.offsets)
+
+    def __getitem__(self, index):
+        return {"input_ids": self.token_ids(index).tolist()}
+
+
+def build_cache(
+    dataset,
+    tokenizer,
+    template,
+    fields,
+    path,
+    add_eos=True,
+    max_length=None,
+    batch_size=1000,
+    meta=None,
+):
+    """
+    Formats and tokenizes every example of dataset into a cache at path. Each example fills
+    template.format(*[example[field] for field in fields]), followed by the EOS token when
+    add_eos is set. Writes into a temporary directory first so an interrupted build is
+    never picked up as a finished cache.
+    """
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    eos = tokenizer.eos_token if add_eos else ""
+    offsets = [0]
+    with open(os.path.join(tmp_path, "tokens.bin"), "wb") as tokens:
+        for start in range(0, len(dataset), batch_size):
+            batch = dataset[start : start + batch_size]
+            columns = [batch[field] for field in fields]
+            texts = [template.format(*values) + eos for values in zip(*columns)]
+            encoded = tokenizer(
+                texts,
+                truncation=max_length is not None,
+                max_length=max_length,
+            )["input_ids"]
+            for ids in encoded:
+                np.asarray(ids, dtype=np.int32).tofile(tokens)
+                offsets.append(offsets[-1] + len(ids))
+
+    np.asarray(offsets, dtype=np.int64).tofile(os.path.join(tmp_path, "offsets.bin"))
+    with open(os.path.join(tmp_path, META_NAME), "w", encoding="utf-8") as file:
+        json.dump({**(meta or {}), "num_examples": len(offsets) - 1, "num_tokens": offsets[-1]}, file, indent=4)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    return TokenCache(path)
+
+
+def pretokenize(
+    dataset,
+    tokenizer,
+    template,
+    fields,
+    cache_dir="token_cache",
+    dataset_version=None,
+    add_eos=True,
+    max_length=None,
+):
+    """
+    Returns a TokenCache for dataset, building it only if no cache exists yet for this
+    tokenizer, template and dataset version. dataset_version defaults to the Hugging Face
+    dataset fingerprint.
+    """
+    if dataset_version is None:
+        dataset_version = dataset_fingerprint(dataset)
+    key = cache_key(tokenizer, template, fields, dataset_version, add_eos, max_length)
+    path = os.path.join(cache_dir, key)
+
+    if os.path.exists(os.path.join(path, META_NAME)):
+        print(f"Using token cache {path}")
+        return TokenCache(path)
+
+    print(f"Building token cache {path}")
+    os.makedirs(cache_dir, exist_ok=True)
+    meta = {
+        "key": key,
+        "tokenizer": getattr(tokenizer, "name_or_path", type(tokenizer).__name__),
+        "template": template,
+        "fields": list(fields),
+        "dataset": dataset_version,
+        "add_eos": add_eos,
+        "max_length": max_length,
+    }
+    return build_cache(dataset, tokenizer, template, fields, path, add_eos, max_length, meta=meta)
@@ -0,0 +1,116 @@
+"""
+Token budget batching with length buckets.
+
+Instead of a fixed number of examples per batch, each batch is filled with examples of
+similar length until it would go over max_tokens padded tokens. A batch of 40 token
+basic_arithmetic rows then holds dozens of examples while a batch of long multiplication
+traces holds a few, and every optimizer step sees about the same number of tokens.
+
+    sampler = TokenBudgetBatchSampler(dataset.lengths(), max_tokens=4096, seed=3407)
+    loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collator)
+"""
+
+import math
+
+import numpy as np
+import torch
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    """
+    Yields lists of dataset indices whose padded size, batch length times the longest
+    example in it, stays within max_tokens.
+
+    lengths         token count of every example, e.g. TokenCache.lengths()
+    bucket_growth   examples are grouped into buckets whose lengths differ by at most this
+                    factor, which bounds the padding inside a batch
+    max_batch_size  optional cap on examples per batch
+    shuffle         shuffle examples within buckets and the order of batches; like
+                    DistributedSampler, call set_epoch at the start of every epoch for a
+                    new order (the Trainer does this)
+
+    An example longer than max_tokens gets a batch of its own.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        max_tokens,
+        bucket_growth=1.1,
+        max_batch_size=None,
+        shuffle=True,
+        seed=0,
+        drop_last=False,
+    ):
+        super().__init__()
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.buckets = np.floor(np.log(np.maximum(self.lengths, 1)) / math.log(bucket_growth)).astype(np.int64)
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def batches(self):
+        """
+        The batches of the current epoch, built once per epoch
+        """
+        if self._batches is not None:
+            return self._batches
+
+        rng = np.random.default_rng([self.seed, self.epoch])
+        order = np.arange(len(self.lengths))
+        if self.shuffle:
+            order = rng.permutation(order)
+        # stable sort keeps the shuffled order inside each bucket
+        order = order[np.argsort(self.buckets[order], kind="stable")]
+
+        batches = []
+        batch = []
+        longest = 0
+        for index in order.tolist():
+            length = int(self.lengths[index])
+            full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (full or (len(batch) + 1) * max(longest, length) > self.max_tokens):
+                batches.append(batch)
+                batch, longest = [], 0
+            batch.append(index)
+            longest = max(longest, length)
+        if batch and not self.drop_last:
+            batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        self._batches = batches
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
+
+    def stats(self):
+        """
+        Batch sizes and real and padded tokens per batch of the current epoch, with the
+        fraction of padded tokens that is padding
+        """
+        batches = self.batches()
+        sizes = np.array([len(batch) for batch in batches])
+        tokens = np.array([int(self.lengths[batch].sum()) for batch in batches])
+        padded = np.array([len(batch) * int(self.lengths[batch].max()) for batch in batches])
+        return {
+            "batches": len(batches),
+            "mean_batch_size": float(sizes.mean()),
+            "max_batch_size": int(sizes.max()),
+            "mean_tokens": float(tokens.mean()),
+            "std_tokens": float(tokens.std()),
+            "mean_padded_tokens": float(padded.mean()),
+            "padding_rate": 1 - float(tokens.sum() / padded.sum()),
+        }